@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+"""Benchmark the BraTS evaluation scripts on synthetic data.
+
+Generates a synthetic cohort of 240x240x155 NIfTI volumes for each imaging
+task (segmentation, inpainting), packs it as zip and tar.gz, then times
+utils.inspect_archive and every validate.py/score.py of the task on it.
+Synapse is replaced by a local stand-in, so nothing is ever uploaded.
+
+Every stage runs in its own process, so that its wall time and peak RSS
+are measured in isolation. Results are written as a JSON report, which
+can be compared with the report of an earlier run, e.g. before and after
+bumping BraTS_evaluation, inpainting or torchmetrics:
+
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+
+EVALUATION_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TASKS = ("segmentation", "inpainting")
+ARCHIVE_FORMATS = ("zip", "tar.gz")
+SHAPE = (240, 240, 155)
+
+# Same orientation as the BraTS volumes (see inpainting/validate.py).
+AFFINE = [
+    [-1.0, 0.0, 0.0, -0.0],
+    [0.0, -1.0, 0.0, 239.0],
+    [0.0, 0.0, 1.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0],
+]
+
+# Cohort labels used for the synthetic scan IDs, per task.
+COHORT_LABELS = {"segmentation": "BraTS-PED", "inpainting": "BraTS-GLI"}
+
+# Packages whose versions are recorded in the report.
+PACKAGES = (
+    "BraTS_evaluation", "panoptica", "inpainting", "torchmetrics", "torch",
+    "nibabel", "numpy", "pandas",
+)
+
+# Entry points whose import is checked by --check_imports, with the time
+# budget (in ms) of importing each of them: about twice the median import
+# time measured on a developer machine, as import times vary from run to run.
+IMPORT_BUDGETS_MS = {
+    "segmentation/validate.py": 130,
+    "segmentation/score.py": 160,
+    "inpainting/validate.py": 120,
+    "inpainting/score.py": 150,
+    "pathology/validate.py": 70,
+    "pathology/score.py": 150,
+    "segmentation/evaluate.py": 170,
+    "inpainting/evaluate.py": 170,
+    "pathology/evaluate.py": 150,
+    "gold_manifest.py": 90,
+}
+
+# Number of imports of each entry point whose median is checked against its
+# budget.
+IMPORT_RUNS = 5
+
+# Modules that entry points must only import on the code path needing them.
+HEAVY_MODULES = (
+    "cnb_tools", "inpainting", "nibabel", "numpy", "pandas", "panoptica",
+    "synapseclient", "torch", "torchmetrics",
+)
+
+# Minimal stand-in for synapseclient: logging in and storing files succeed
+# without any network access, and stored files get made-up Synapse IDs.
+FAKE_SYNAPSECLIENT = {
+    "synapseclient/__init__.py": '''\
+"""Stand-in for synapseclient, used by benchmark.py."""
+import itertools
+
+_ids = itertools.count(1)
+
+
+class File:
+    def __init__(self, path, parent=None, **kwargs):
+        self.path = path
+        self.parentId = parent
+
+
+class Synapse:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def store(self, entity, **kwargs):
+        entity.id = f"syn{next(_ids)}"
+        return entity
+''',
+    "synapseclient/core/__init__.py": "",
+    "synapseclient/core/exceptions.py": '''\
+class SynapseError(Exception):
+    pass
+
+
+class SynapseAuthenticationError(SynapseError):
+    pass
+
+
+class SynapseAuthorizationError(SynapseError):
+    pass
+
+
+class SynapseNotFoundError(SynapseError):
+    pass
+''',
+}
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the evaluation scripts on synthetic data."
+    )
+    parser.add_argument("-n", "--cases", type=int, default=5,
+                        help="Number of cases in the synthetic cohorts.")
+    parser.add_argument("--tasks", nargs="+", choices=TASKS, default=list(TASKS))
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of runs per stage; the fastest is reported.")
+    parser.add_argument("--script_args", action="append", default=[],
+                        metavar="SCRIPT=ARGS",
+                        help="Extra arguments for a script, e.g. "
+                             "'segmentation/score.py=--in_process --shards 4'.")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Directory to generate the cohorts and run the "
+                             "scripts in (default: a temporary directory).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Report of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative slowdown over --baseline above which a "
+                             "stage counts as a regression.")
+    parser.add_argument("--check_imports", action="store_true",
+                        help="Only check that importing every entry point "
+                             "stays within its budget (IMPORT_BUDGETS_MS), "
+                             "in the median of IMPORT_RUNS imports, "
+                             "and imports none of HEAVY_MODULES.")
+    return parser.parse_args()
+
+
+def _save(data, path):
+    import nibabel as nib
+    import numpy as np
+
+    nib.save(nib.Nifti1Image(data, np.array(AFFINE)), path)
+
+
+def _blobs(rng, count, max_radius=20):
+    """Return a random label map made of `count` ellipsoids, labelled 1-4."""
+    import numpy as np
+
+    grid = np.ogrid[tuple(slice(0, size) for size in SHAPE)]
+    seg = np.zeros(SHAPE, dtype=np.uint8)
+    for _ in range(count):
+        center = rng.uniform(40, np.array(SHAPE) - 40)
+        radii = rng.uniform(3, max_radius, size=3)
+        inside = sum(((axis - c) / r) ** 2 for axis, c, r in zip(grid, center, radii))
+        seg[inside <= 1] = rng.integers(1, 5)
+    return seg
+
+
+def _brain(rng):
+    """Return a random T1-like int16 volume: a noisy ellipsoid of tissue."""
+    import numpy as np
+
+    grid = np.ogrid[tuple(slice(0, size) for size in SHAPE)]
+    center = np.array(SHAPE) / 2
+    inside = sum(((axis - c) / (0.4 * s)) ** 2 for axis, c, s in zip(grid, center, SHAPE))
+    brain = rng.normal(800, 150, SHAPE) * (inside <= 1)
+    return np.clip(brain, 0, None).astype(np.int16)
+
+
+def make_segmentation_cohort(path, cases, rng):
+    """
+    Write reference and (perturbed) predicted label maps of `cases` scans
+    to path/ref and path/pred.
+    """
+    import numpy as np
+
+    label = COHORT_LABELS["segmentation"]
+    for subdir in ("ref", "pred"):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    for case in range(cases):
+        scan_id = f"{label}-{case:05d}-000"
+        ref = _blobs(rng, count=6)
+        pred = np.roll(ref, rng.integers(-3, 4, size=3), axis=(0, 1, 2))
+        pred[_blobs(rng, count=2, max_radius=8) > 0] = rng.integers(1, 5)
+        _save(ref, os.path.join(path, "ref", f"{scan_id}-seg.nii.gz"))
+        _save(pred, os.path.join(path, "pred", f"{scan_id}.nii.gz"))
+
+
+def make_inpainting_cohort(path, cases, rng):
+    """
+    Write reference T1 scans, healthy masks, voided T1 scans and (noisy)
+    inpainted predictions of `cases` scans to path/{ref,masks,pred}.
+    """
+    import numpy as np
+
+    label = COHORT_LABELS["inpainting"]
+    for subdir in ("ref", "masks", "pred"):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    for case in range(cases):
+        scan_id = f"{label}-{case:05d}-000"
+        t1n = _brain(rng)
+        mask = (_blobs(rng, count=1, max_radius=15) > 0).astype(np.uint8)
+        voided = t1n * (1 - mask)
+        pred = (t1n + rng.normal(0, 50, SHAPE) * mask).astype(np.float32)
+        _save(t1n, os.path.join(path, "ref", f"{scan_id}-t1n.nii.gz"))
+        _save(mask, os.path.join(path, "masks", f"{scan_id}-mask-healthy.nii.gz"))
+        _save(voided, os.path.join(path, "masks", f"{scan_id}-t1n-voided.nii.gz"))
+        _save(pred, os.path.join(path, "pred", f"{scan_id}-t1n-inference.nii.gz"))
+
+
+def pack(directory, archive):
+    """Pack the files of a directory into a zip or tar.gz archive."""
+    files = sorted(os.listdir(directory))
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name in files:
+                zf.write(os.path.join(directory, name), name)
+    else:
+        with tarfile.open(archive, "w:gz") as tf:
+            for name in files:
+                tf.add(os.path.join(directory, name), name)
+
+
+def write_fake_synapseclient(path):
+    """Write the synapseclient stand-in to path, to put on PYTHONPATH."""
+    for name, source in FAKE_SYNAPSECLIENT.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), "w", encoding="utf-8") as out:
+            out.write(source)
+
+
+def run_stage(cmd, cwd, env):
+    """
+    Run a command to completion. Returns its wall time (s), peak RSS (MB)
+    and return code, with its output saved to cwd/output.log.
+    """
+    os.makedirs(cwd, exist_ok=True)
+    with open(os.path.join(cwd, "output.log"), "wb") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log, stderr=log)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    rss_kb = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return {
+        "wall_s": round(wall, 3),
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+        "returncode": proc.returncode,
+    }
+
+
+def _stages(task, archives, script_args):
+    """Return the (name, command) of every stage to benchmark for a task."""
+    python = sys.executable
+    label = COHORT_LABELS[task]
+    entity = ["-e", "org.sagebionetworks.repo.model.FileEntity"]
+    stages = []
+    for fmt in ARCHIVE_FORMATS:
+        preds = archives[f"pred.{fmt}"]
+        stages.append((
+            f"{task}/inspect_archive[{fmt}]",
+            [python, "-c",
+             "import sys, utils; utils.inspect_archive(sys.argv[1], path=sys.argv[2])",
+             preds, "extracted"],
+        ))
+        if task == "segmentation":
+            validate = [
+                "-p", preds, "-g", archives[f"ref.{fmt}"], *entity, "-l", label,
+                "-o", "results.json",
+            ]
+            score = [
+                "--parent_id", "syn0", "--private_parent_id", "syn0",
+                "-p", preds, "-g", archives[f"ref.{fmt}"], "-l", label,
+                "-o", "results.json",
+            ]
+        else:
+            validate = [
+                "-p", preds, "-g", archives[f"masks.{fmt}"], *entity,
+                "--pred_pattern", r"(\d{5}-\d{3})-t1n-inference",
+                "--gold_pattern", r"(\d{5}-\d{3})-mask-healthy",
+                "-o", "results.json",
+            ]
+            score = [
+                "--parent_id", "syn0", "-p", preds, "-g", archives[f"ref.{fmt}"],
+                "-m", archives[f"masks.{fmt}"], "-l", label, "-o", "results.json",
+            ]
+        for script, args in (("validate.py", validate), ("score.py", score)):
+            name = f"{task}/{script}"
+            args = args + shlex.split(script_args.get(name, ""))
+            stages.append(
+                (f"{name}[{fmt}]", [python, os.path.join(EVALUATION_DIR, name), *args])
+            )
+    return stages
+
+
+def import_profile(script, env):
+    """
+    Import a script (without running its main) under `python -X importtime`.
+    Returns the total import time (ms) of its imports, and the top-level
+    modules they loaded.
+    """
+    path = os.path.join(EVALUATION_DIR, script)
+    code = (
+        "import importlib.util, sys; "
+        "sys.stderr.write('--- script ---\\n'); "
+        "spec = importlib.util.spec_from_file_location('script', sys.argv[1]); "
+        "spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, path],
+        cwd=os.path.dirname(path), env=env, capture_output=True, text=True,
+        check=True,
+    )
+    _, _, log = proc.stderr.partition("--- script ---\n")
+    total_us, modules = 0, set()
+    for line in log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented, and already counted by their parent.
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+        modules.add(name.strip().split(".")[0])
+    return total_us / 1000, modules
+
+
+def check_imports(env):
+    """
+    Check the median import time of every entry point against its budget.
+    Returns a line per script, and the scripts over budget or importing
+    HEAVY_MODULES.
+    """
+    lines, failures = [], []
+    for script, budget in IMPORT_BUDGETS_MS.items():
+        # The first import also pays for compiling and caching bytecode.
+        import_profile(script, env)
+        profiles = [import_profile(script, env) for _ in range(IMPORT_RUNS)]
+        import_ms = statistics.median(import_ms for import_ms, _ in profiles)
+        modules = set().union(*(modules for _, modules in profiles))
+        heavy = sorted(modules.intersection(HEAVY_MODULES))
+        line = f"{script}: {import_ms:.1f} ms (budget {budget} ms)"
+        if heavy:
+            line += f", imports {', '.join(heavy)}"
+        if heavy or import_ms > budget:
+            line += "  FAILED"
+            failures.append(script)
+        lines.append(line)
+    return lines, failures
+
+
+def _package_versions():
+    versions = {}
+    for package in PACKAGES:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def benchmark(work_dir, tasks, cases, repeat=1, script_args=None, seed=0):
+    """Generate the cohorts, run every stage and return the report."""
+    import numpy as np
+
+    script_args = script_args or {}
+    rng = np.random.default_rng(seed)
+    stubs = os.path.join(work_dir, "stubs")
+    write_fake_synapseclient(stubs)
+    # Scripts also call console scripts (e.g. brats-evaluate) of the same
+    # environment as this interpreter.
+    env = dict(
+        os.environ,
+        PATH=os.pathsep.join(
+            filter(None, (os.path.dirname(sys.executable), os.environ.get("PATH")))
+        ),
+        PYTHONPATH=os.pathsep.join(
+            filter(None, (stubs, EVALUATION_DIR, os.environ.get("PYTHONPATH")))
+        ),
+    )
+    generators = {
+        "segmentation": make_segmentation_cohort,
+        "inpainting": make_inpainting_cohort,
+    }
+
+    stages = {}
+    for task in tasks:
+        cohort = os.path.join(work_dir, task)
+        start = time.perf_counter()
+        generators[task](cohort, cases, rng)
+        stages[f"{task}/generate"] = {"wall_s": round(time.perf_counter() - start, 3)}
+
+        archives = {}
+        for subdir in sorted(os.listdir(cohort)):
+            for fmt in ARCHIVE_FORMATS:
+                archive = archives[f"{subdir}.{fmt}"] = os.path.join(
+                    work_dir, f"{task}-{subdir}.{fmt}"
+                )
+                start = time.perf_counter()
+                pack(os.path.join(cohort, subdir), archive)
+                stages[f"{task}/pack[{subdir}.{fmt}]"] = {
+                    "wall_s": round(time.perf_counter() - start, 3)
+                }
+
+        for name, cmd in _stages(task, archives, script_args):
+            runs = []
+            for run in range(repeat):
+                cwd = os.path.join(work_dir, "runs", name.replace("/", "-"), str(run))
+                runs.append(run_stage(cmd, cwd, env))
+                print(f"{name}: {runs[-1]}", file=sys.stderr)
+            stages[name] = {
+                "wall_s": min(r["wall_s"] for r in runs),
+                "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+                "returncode": next(
+                    (r["returncode"] for r in runs if r["returncode"]), 0
+                ),
+            }
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": _package_versions(),
+        "cohort": {"cases": cases, "shape": list(SHAPE), "seed": seed},
+        "repeat": repeat,
+        "script_args": script_args,
+        "stages": stages,
+    }
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Compare the stages of two reports. Returns lines describing the change
+    of each stage, and the names of stages that got slower than `tolerance`.
+    """
+    lines, regressions = [], []
+    for name, stage in report["stages"].items():
+        before = baseline["stages"].get(name)
+        if not before or not before.get("wall_s"):
+            lines.append(f"{name}: {stage['wall_s']:.3f}s (new)")
+            continue
+        if before.get("returncode") or stage.get("returncode"):
+            lines.append(f"{name}: {stage['wall_s']:.3f}s (failed, not compared)")
+            continue
+        ratio = stage["wall_s"] / before["wall_s"]
+        line = f"{name}: {before['wall_s']:.3f}s -> {stage['wall_s']:.3f}s ({ratio:.2f}x)"
+        if "peak_rss_mb" in stage and before.get("peak_rss_mb"):
+            line += f", {before['peak_rss_mb']:.0f} -> {stage['peak_rss_mb']:.0f} MB"
+        if ratio > 1 + tolerance:
+            line += "  REGRESSION"
+            regressions.append(name)
+        lines.append(line)
+    return lines, regressions
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    script_args = dict(arg.split("=", 1) for arg in args.script_args)
+
+    if args.check_imports:
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(
+                filter(None, (EVALUATION_DIR, os.environ.get("PYTHONPATH")))
+            ),
+        )
+        lines, failures = check_imports(env)
+        print("\n".join(lines))
+        sys.exit(1 if failures else 0)
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        report = benchmark(args.work_dir, args.tasks, args.cases, args.repeat,
+                           script_args, args.seed)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = benchmark(work_dir, args.tasks, args.cases, args.repeat,
+                               script_args, args.seed)
+
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(report, out, indent=2)
+
+    failed = [name for name, stage in report["stages"].items()
+              if stage.get("returncode")]
+    for name in failed:
+        print(f"{name} failed, see its output.log in --work_dir", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            lines, regressions = compare(report, json.load(f), args.tolerance)
+        print("\n".join(lines))
+
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Build the manifest of a goldstandard archive.
+
+The manifest lists the archive's files, their sizes and case IDs, so that
+validation does not need to list the archive itself. Rebuild it whenever
+the goldstandard changes; a manifest whose digest no longer matches the
+archive is ignored.
+"""
+
+import argparse
+import json
+
+import utils
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--goldstandard_file",
+                        type=str, required=True)
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Defaults to <goldstandard_file>.manifest.json.")
+    parser.add_argument("--gold_pattern", type=str, default=None,
+                        help="Regex capturing the case ID of gold filenames.")
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    manifest = utils.build_manifest(args.goldstandard_file, args.gold_pattern)
+    output = args.output or f"{args.goldstandard_file}.manifest.json"
+    with open(output, "w", encoding="utf-8") as out:
+        json.dump(manifest, out)
+    print(f"Wrote manifest of {len(manifest['members'])} files to {output}")
+
+
+if __name__ == "__main__":
+    main()
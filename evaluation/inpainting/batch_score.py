@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Batch scoring script for BraTS inpainting task.
+
+Score several submissions against the same goldstandard in one run, e.g.
+to rescore a whole phase: the goldstandard is extracted and decoded only
+once, and the scans of all submissions are scored in one process pool.
+Each submission gets its own all_scores.csv and results.json, the same as
+score.py writes (without Synapse IDs, as nothing is uploaded), in a
+subdirectory of --output_dir named after its predictions file.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import score
+import utils
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--predictions_files",
+                        type=str, nargs="+", required=True)
+    parser.add_argument("-g", "--goldstandard_file",
+                        type=str, default="/goldstandard.zip")
+    parser.add_argument("-m", "--healthy_masks_file",
+                        type=str, default="/masks.zip")
+    parser.add_argument("-l", "--label",
+                        type=str, default="BraTS-GLI")
+    parser.add_argument("-o", "--output_dir",
+                        type=str, default="batch")
+    parser.add_argument("--workers",
+                        type=int, default=os.cpu_count(),
+                        help="Number of scans to score concurrently.")
+    parser.add_argument("--cache_dir",
+                        type=str, default=None,
+                        help="Directory to cache extracted and decoded "
+                             "goldstandard files in, across runs.")
+    parser.add_argument("--memo_dir",
+                        type=str, default=None,
+                        help="Directory to memoize per-scan scores in.")
+    parser.add_argument("--slab_size",
+                        type=int, default=None,
+                        help="Decode and score scans this many axial slices "
+                             "at a time (see score.py).")
+    return parser.parse_args()
+
+
+def _decode_reference(path):
+    """Decode a reference volume into its cache (see score.read_reference)."""
+    score.read_reference(path, cached=True)
+
+
+def score_submissions(submissions, label, gold_dir, mask_dir, workers=1,
+                      memo_dir=None, slab_size=None):
+    """
+    Score the scans of several submissions, given as {name: (pred_dir,
+    preds)}, in one process pool. Returns {name: per-scan scores} and
+    {name: identifiers of the scans that failed to score}.
+
+    The reference volumes of all scans are decoded once up front, and then
+    memory-mapped by every scan using them. A scan that fails to score is
+    reported and does not stop the others from being scored, but its
+    submission is then not scored, as score.score fails the run for it.
+    """
+    cases = {
+        (name, pred): (pred, label, pred_dir, gold_dir, mask_dir)
+        for name, (pred_dir, preds) in submissions.items()
+        for pred in preds
+    }
+    scores = {name: [] for name in submissions}
+    keys, pending = {}, []
+    for case, args in cases.items():
+        result = None
+        if memo_dir:
+            keys[case] = score.case_key(*args)
+            result = utils.memo_get(memo_dir, keys[case])
+        if result is None:
+            pending.append(case)
+        else:
+            scores[case[0]].append(tuple(result))
+
+    def on_result(case, result):
+        scores[case[0]].append(result)
+        if memo_dir:
+            utils.memo_put(memo_dir, keys[case], result)
+
+    if not slab_size:
+        references = sorted({
+            path
+            for case in pending
+            for key, path in score.case_files(*cases[case])[1].items()
+            if key != "pred" and os.path.exists(path)
+        })
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_decode_reference, references))
+
+    failed = {name: [] for name in submissions}
+    for name, pred in score.score_in_pool(
+        {case: cases[case] + (True, slab_size) for case in pending},
+        workers, on_result,
+    ):
+        failed[name].append(score.case_files(*cases[name, pred])[0])
+    return scores, {name: sorted(ids) for name, ids in failed.items()}
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    stems = utils.unique_stems(args.predictions_files)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gold_dir, _ = utils.extract_cached(
+            args.goldstandard_file, os.path.join(tmp_dir, score.GOLD_DIR),
+            args.cache_dir, pattern="t1n",
+        )
+        mask_dir, _ = utils.extract_cached(
+            args.healthy_masks_file, os.path.join(tmp_dir, score.MASK_DIR),
+            args.cache_dir,
+        )
+        submissions = {}
+        for name, predictions_file in stems.items():
+            pred_dir = os.path.join(tmp_dir, score.PRED_DIR, name)
+            submissions[name] = (
+                pred_dir, utils.inspect_archive(predictions_file, path=pred_dir)
+            )
+
+        scores, failed_scans = score_submissions(
+            submissions, args.label, gold_dir, mask_dir, args.workers,
+            args.memo_dir, args.slab_size,
+        )
+
+    failed = []
+    for name, results in scores.items():
+        out_dir = os.path.join(args.output_dir, name)
+        os.makedirs(out_dir, exist_ok=True)
+        if failed_scans[name] or not results:
+            failed.append(name)
+            res_dict = {
+                "submission_status": "NOT_SCORED",
+                "submission_errors": (
+                    score.failed_message(failed_scans[name]) if failed_scans[name]
+                    else "None of the predictions could be scored."
+                ),
+            }
+        else:
+            results, res_dict = score.summarize(score.to_frame(results))
+            results.to_csv(os.path.join(out_dir, "all_scores.csv"))
+            res_dict["submission_status"] = "SCORED"
+        with open(os.path.join(out_dir, "results.json"), "w", encoding="utf-8") as out:
+            json.dump(res_dict, out)
+        print(f"{name}: {res_dict['submission_status']}")
+
+    if failed:
+        sys.exit(f"Could not score: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
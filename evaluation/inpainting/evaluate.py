@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Validation and scoring script for BraTS inpainting task.
+
+Runs validate.py and then, for a valid submission, score.py in one process,
+instead of as two workflow steps in separate containers: the predictions
+and healthy masks archives are extracted once, and scoring works on the
+files validation checked. Validation results go to --validation_output;
+scoring results go to --output, which holds the validation results
+instead if the submission is invalid.
+"""
+import argparse
+import shutil
+import tempfile
+
+import score
+import uploader
+import utils
+import validate
+import worker
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parent_id",
+                        type=str, required=True)
+    parser.add_argument("--private_parent_id",
+                        type=str, default=None,
+                        help="Synapse folder to upload the timings to; they "
+                             "are not uploaded without it.")
+    parser.add_argument("-s", "--synapse_config",
+                        type=str, default="/.synapseConfig")
+    parser.add_argument("--synapse_endpoint",
+                        type=str, default=None,
+                        help="Base URL of the Synapse server to upload to, "
+                             "if not the public one.")
+    parser.add_argument("-p", "--predictions_file",
+                        type=str, default="/predictions.zip")
+    parser.add_argument("-g", "--goldstandard_file",
+                        type=str, default="/goldstandard.zip")
+    parser.add_argument("-m", "--healthy_masks_file",
+                        type=str, default="/masks.zip")
+    parser.add_argument("-e", "--entity_type",
+                        type=str, required=True)
+    parser.add_argument("-o", "--output",
+                        type=str, default="results.json")
+    parser.add_argument("--validation_output",
+                        type=str, default="validation_results.json")
+    parser.add_argument("--pred_pattern", type=str,
+                        default="(\\d{5}-\\d{3})-t1n-inference")
+    parser.add_argument("--gold_pattern", type=str,
+                        default="(\\d{5}-\\d{3})-mask-healthy")
+    parser.add_argument("-l", "--label",
+                        type=str, default="BraTS-GLI")
+    parser.add_argument("--workers",
+                        type=int, default=1,
+                        help="Number of cases to score concurrently.")
+    parser.add_argument("--cache_dir",
+                        type=str, default=None,
+                        help="Directory to cache extracted and decoded "
+                             "goldstandard files in.")
+    parser.add_argument("--memory_budget",
+                        type=float, default=None,
+                        help="Memory (in GB) to use for decoding batches of "
+                             "scans ahead of scoring them; by default, one "
+                             "scan is decoded at a time.")
+    parser.add_argument("--memo_dir",
+                        type=str, default=None,
+                        help="Directory to memoize per-scan scores in, shared "
+                             "across submissions.")
+    parser.add_argument("--slab_size",
+                        type=int, default=None,
+                        help="Decode and score scans this many axial slices "
+                             "at a time, to bound the memory used per scan.")
+    parser.add_argument("--timings_file",
+                        type=str, default="timings.json",
+                        help="File to record the time and memory used by "
+                             "each stage in.")
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    timings = {}
+
+    with tempfile.TemporaryDirectory() as tmp_pred_dir, \
+         tempfile.TemporaryDirectory() as tmp_gold_dir, \
+         tempfile.TemporaryDirectory() as tmp_mask_dir:
+
+        entity_type = args.entity_type.split(".")[-1]
+        if entity_type != "FileEntity":
+            invalid_reasons = [f"Submission must be a File, not {entity_type}."]
+        else:
+            with utils.timed(timings, "extract"):
+                preds = utils.inspect_archive(args.predictions_file, path=tmp_pred_dir)
+                mask_dir, masks = utils.extract_cached(
+                    args.healthy_masks_file, tmp_mask_dir, args.cache_dir
+                )
+            golds = [mask for mask in masks if validate.GOLD_PATTERN in mask]
+            invalid_reasons = validate.validate_predictions(
+                preds, golds, tmp_pred_dir, args.pred_pattern,
+                args.gold_pattern, timings,
+            )
+        status = validate.write_results(invalid_reasons, args.validation_output)
+
+        if status != "VALIDATED":
+            shutil.copyfile(args.validation_output, args.output)
+            return
+
+        # Log in and upload in the background, while scans are being scored.
+        with uploader.pipeline(
+            args.synapse_config, args.synapse_endpoint, timings=timings
+        ) as upload:
+            with utils.timed(timings, "extract_goldstandard"):
+                gold_dir, _ = utils.extract_cached(
+                    args.goldstandard_file, tmp_gold_dir, args.cache_dir, pattern="t1n"
+                )
+            results = score.score_submission(
+                preds, args.label, tmp_pred_dir, gold_dir, mask_dir, upload,
+                args.parent_id, timings,
+                workers=args.workers,
+                cache_refs=bool(args.cache_dir),
+                batch=score.batch_size(args.memory_budget),
+                memo_dir=args.memo_dir,
+                slab_size=args.slab_size,
+            )
+            utils.write_timings(args.timings_file, timings)
+            if args.private_parent_id:
+                upload(args.timings_file, args.private_parent_id)
+
+    score.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    worker.run(main, __file__)
@@ -8,19 +8,32 @@ Compute the following metrics for the inpainted images:
 """
 import os
 import re
+import sys
 import tempfile
 import argparse
 import json
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-from inpainting.challenge_metrics_2023 import generate_metrics, read_nifti_to_tensor
-import pandas as pd
-import synapseclient
-
+import uploader
 import utils
+import worker
 
 GOLD_DIR = "ref"
 MASK_DIR = "masks"
 PRED_DIR = "pred"
+DECODED_DIR = "decoded"
+
+# Rough peak memory needed to score one scan: its four float32 volumes of
+# 240x240x155, plus the intermediate tensors of generate_metrics.
+CASE_MEMORY_BYTES = 12 * 240 * 240 * 155 * 4
+
+# Number of neighbouring slices on each side that an SSIM value depends on:
+# half the width of the 11-voxel gaussian window of torchmetrics' SSIM.
+SSIM_HALO = 5
+
+# Packages whose versions determine the computed scores
+METRICS_PACKAGES = ("inpainting", "torchmetrics")
 
 
 def get_args():
@@ -28,8 +41,16 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--parent_id",
                         type=str, required=True)
+    parser.add_argument("--private_parent_id",
+                        type=str, default=None,
+                        help="Synapse folder to upload the timings (and "
+                             "profile) to; they are not uploaded without it.")
     parser.add_argument("-s", "--synapse_config",
                         type=str, default="/.synapseConfig")
+    parser.add_argument("--synapse_endpoint",
+                        type=str, default=None,
+                        help="Base URL of the Synapse server to upload to, "
+                             "if not the public one.")
     parser.add_argument("-p", "--predictions_file",
                         type=str, default="/predictions.zip")
     parser.add_argument("-g", "--goldstandard_file",
@@ -40,74 +61,483 @@ def get_args():
                         type=str, default="results.json")
     parser.add_argument("-l", "--label",
                         type=str, default="BraTS-GLI")
+    parser.add_argument("--workers",
+                        type=int, default=1,
+                        help="Number of cases to score concurrently.")
+    parser.add_argument("--cache_dir",
+                        type=str, default=None,
+                        help="Directory to cache extracted and decoded "
+                             "goldstandard files in.")
+    parser.add_argument("--memory_budget",
+                        type=float, default=None,
+                        help="Memory (in GB) to use for decoding batches of "
+                             "scans ahead of scoring them; by default, one "
+                             "scan is decoded at a time.")
+    parser.add_argument("--checkpoint_file",
+                        type=str, default=None,
+                        help="File to record per-scan scores in, so that a "
+                             "rerun only scores the scans still missing.")
+    parser.add_argument("--memo_dir",
+                        type=str, default=None,
+                        help="Directory to memoize per-scan scores in, shared "
+                             "across submissions.")
+    parser.add_argument("--slab_size",
+                        type=int, default=None,
+                        help="Decode and score scans this many axial slices "
+                             "at a time, to bound the memory used per scan.")
+    parser.add_argument("--timings_file",
+                        type=str, default="timings.json",
+                        help="File to record the time and memory used by "
+                             "each stage in.")
+    parser.add_argument("--profile",
+                        type=str, default=None,
+                        help="File to dump cProfile stats of the scoring in.")
     return parser.parse_args()
 
 
-def calculate_metrics(pred, healthy_mask, ref_t1n, voided_t1n=None):
+def read_reference(path, cached=False):
+    """
+    Read a reference volume with read_nifti_to_tensor. If `cached`, the
+    decoded volume is also saved as an uncompressed .npy file next to it,
+    and later calls memory-map that file instead of decoding the NIfTI again.
+    """
+    from inpainting.challenge_metrics_2023 import read_nifti_to_tensor
+    import numpy as np
+    import torch
+
+    if not cached:
+        return read_nifti_to_tensor(path)
+
+    decoded_dir = os.path.join(os.path.dirname(path), DECODED_DIR)
+    decoded = os.path.join(
+        decoded_dir, os.path.basename(path).replace(".nii.gz", ".npy")
+    )
+    if not os.path.exists(decoded):
+        os.makedirs(decoded_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=decoded_dir)
+        with os.fdopen(fd, "wb") as out:
+            np.save(out, read_nifti_to_tensor(path).numpy())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, decoded)
+
+    # Copy-on-write, so that the cached file is never modified.
+    return torch.from_numpy(np.load(decoded, mmap_mode="c"))
+
+
+def load_volumes(pred, healthy_mask, ref_t1n, voided_t1n=None, cache_refs=False):
+    """Read the prediction and reference volumes of a scan."""
+    from inpainting.challenge_metrics_2023 import read_nifti_to_tensor
+
+    return {
+        "prediction": read_nifti_to_tensor(pred),
+        "target": read_reference(ref_t1n, cache_refs),
+        "normalization_tensor": (
+            read_reference(voided_t1n, cache_refs) if voided_t1n is not None else None
+        ),
+        "mask": read_reference(healthy_mask, cache_refs).bool(),
+    }
+
+
+def calculate_metrics(pred, healthy_mask, ref_t1n, voided_t1n=None, cache_refs=False):
     """
     Run inpainting computation of prediction scan against
     goldstandard, healthy mask, and voided T1 scan.
     """
+    from inpainting.challenge_metrics_2023 import generate_metrics
 
-    prediction_data = read_nifti_to_tensor(pred)
-    healthy_mask_data = read_nifti_to_tensor(healthy_mask).bool()
-    reference_t1_data = read_nifti_to_tensor(ref_t1n)
-    if voided_t1n is not None:
-        voided_t1_data = read_nifti_to_tensor(voided_t1n)
-    else:
-        voided_t1_data = None
-
-    # Compute metrics
-    metrics = generate_metrics(
-        prediction=prediction_data,
-        target=reference_t1_data,
-        normalization_tensor=voided_t1_data,
-        mask=healthy_mask_data,
+    volumes = load_volumes(pred, healthy_mask, ref_t1n, voided_t1n, cache_refs)
+    return generate_metrics(**volumes)
+
+
+def _read_slabs(img, slab_size):
+    """
+    Yield (first slice, slab) pairs covering a volume, decoding `slab_size`
+    axial slices at a time the same way as read_nifti_to_tensor.
+    """
+    import numpy as np
+    import torch
+
+    dtype = img.header.get_data_dtype()
+    for z in range(0, img.shape[-1], slab_size):
+        slab = np.asarray(img.dataobj[..., z:z + slab_size], dtype=np.float64)
+        yield z, torch.Tensor(slab.astype(dtype, copy=False)).numpy()
+
+
+def _positions(index, shape, mask, z):
+    """
+    Return where the masked voxels of a slab starting at slice `z` fall
+    among the masked voxels of the whole volume, given by their flat
+    `index` in a volume of that `shape`.
+    """
+    import numpy as np
+
+    x, y, slab_z = np.nonzero(mask)
+    flat = np.ravel_multi_index((x, y, slab_z + z), shape)
+    return np.searchsorted(index, flat)
+
+
+def _normalize(tensor, v_min, v_max):
+    """Clip and rescale like _normalize_with_percentiles, given its percentiles."""
+    import numpy as np
+
+    output = np.clip(tensor, v_min, v_max)
+    return (output - v_min) / (v_max - v_min)
+
+
+def calculate_metrics_slabs(pred, healthy_mask, ref_t1n, voided_t1n, slab_size):
+    """
+    Compute the same scores as calculate_metrics, without ever holding the
+    prediction and reference volumes, or SSIM's intermediate images, in
+    memory all at once.
+
+    Only the voxels inside the healthy mask count towards the scores, so
+    the prediction and reference are decoded slab by slab, keeping just
+    their masked voxels. Outside the mask, the normalized volumes are the
+    same constant, so SSIM is then computed slab by slab on volumes rebuilt
+    from the masked voxels, with SSIM_HALO neighbouring slices on each side.
+    The voided scan is still read whole, for its percentiles.
+
+    Falls back to calculate_metrics for scans whose values could not be
+    reproduced exactly this way (scaled or non-3D volumes, empty masks,
+    non-finite values outside the mask).
+    """
+    from inpainting.challenge_metrics_2023 import (
+        _mean_absolute_error,
+        _mean_squared_error,
+        _mean_squared_log_error,
+        _peak_signal_noise_ratio,
     )
-    return pd.DataFrame([metrics])
-
-
-def score(pred_lst, label, pred_dir=PRED_DIR, gold_dir=GOLD_DIR, mask_dir=MASK_DIR):
-    """Compute and return scores for each scan."""
-    scores = []
-    for pred in pred_lst:
-        scan_id = re.search(r"\d{5}-\d{3}", pred).group()
-        identifier = f"{label}-{scan_id}"
-        mask = os.path.join(mask_dir, f"{identifier}-mask-healthy.nii.gz")
-        gold = os.path.join(gold_dir, f"{identifier}-t1n.nii.gz")
-        voided = os.path.join(mask_dir, f"{identifier}-t1n-voided.nii.gz")
-
-        results = (
-            calculate_metrics(
-                pred=os.path.join(pred_dir, pred),
-                healthy_mask=mask,
-                ref_t1n=gold,
-                voided_t1n=voided,
-            )
-            .assign(scan_id=identifier)
-            .set_index("scan_id")
+    import nibabel as nib
+    import numpy as np
+    import torch
+    from torchmetrics.functional.image import structural_similarity_index_measure
+
+    def fallback():
+        return calculate_metrics(pred, healthy_mask, ref_t1n, voided_t1n)
+
+    imgs = [
+        nib.load(path, keep_file_open=True)
+        for path in (pred, healthy_mask, ref_t1n, voided_t1n)
+    ]
+    shape = imgs[0].shape
+    if any(
+        img.shape != shape or img.dataobj.slope != 1 or img.dataobj.inter != 0
+        for img in imgs
+    ) or len(shape) != 3:
+        return fallback()
+    pred_img, mask_img, ref_img, voided_img = imgs
+
+    mask = np.empty(shape, dtype=bool)
+    for z, slab in _read_slabs(mask_img, slab_size):
+        mask[..., z:z + slab.shape[-1]] = slab != 0
+    index = np.flatnonzero(mask)
+    if not index.size:
+        return fallback()
+
+    voided = np.empty(shape, dtype=np.float32)
+    for z, slab in _read_slabs(voided_img, slab_size):
+        voided[..., z:z + slab.shape[-1]] = slab
+    v_min, v_max = np.percentile(voided, [0.5, 99.5])
+    v_min = max(v_min, 0.0)
+    del voided
+
+    # Masked voxels of the prediction and reference, in the same order as
+    # indexing the whole volumes with the mask.
+    masked = {"prediction": np.empty(index.size, dtype=np.float32),
+              "target": np.empty(index.size, dtype=np.float32)}
+    slabs = zip(_read_slabs(pred_img, slab_size), _read_slabs(ref_img, slab_size))
+    for (z, pred_slab), (_, ref_slab) in slabs:
+        slab_mask = mask[..., z:z + pred_slab.shape[-1]]
+        positions = _positions(index, shape, slab_mask, z)
+        for name, slab in (("prediction", pred_slab), ("target", ref_slab)):
+            if not np.isfinite(slab[~slab_mask]).all():
+                return fallback()
+            masked[name][positions] = slab[slab_mask]
+
+    background = _normalize(torch.zeros(1), v_min, v_max)
+    masked = {
+        name: _normalize(torch.from_numpy(values), v_min, v_max)
+        for name, values in masked.items()
+    }
+    if index.size < mask.size:
+        ranges = [torch.cat((values, background)) for values in masked.values()]
+    else:
+        ranges = list(masked.values())
+    data_range = max(values.max() - values.min() for values in ranges)
+
+    ssim = torch.empty(index.size)
+    depth = shape[-1]
+    for z in range(0, depth, slab_size):
+        end = min(z + slab_size, depth)
+        start, stop = max(0, z - SSIM_HALO), min(depth, end + SSIM_HALO)
+        window_mask = torch.from_numpy(mask[..., start:stop])
+        positions = _positions(index, shape, mask[..., start:stop], start)
+        windows = {}
+        for name, values in masked.items():
+            window = torch.full(window_mask.shape, background.item())
+            window[window_mask] = values[positions]
+            windows[name] = window.unsqueeze(0)
+        _, ssim_image = structural_similarity_index_measure(
+            preds=windows["prediction"],
+            target=windows["target"],
+            data_range=data_range,
+            return_full_image=True,
+        )
+        slab_mask = mask[..., z:end]
+        ssim[_positions(index, shape, slab_mask, z)] = (
+            ssim_image[0, ..., z - start:end - start][torch.from_numpy(slab_mask)]
         )
-        scores.append(results)
-    return pd.concat(scores).sort_values(by="scan_id")
 
+    # Same as generate_metrics, on the masked voxels.
+    target, prediction = masked["target"], masked["prediction"]
+    return {
+        "ssim": ssim.mean().item(),
+        "mse": _mean_squared_error(
+            target=target, prediction=prediction, squared=True
+        ).item(),
+        "rmse": _mean_squared_error(
+            target=target, prediction=prediction, squared=False
+        ).item(),
+        "msle": _mean_squared_log_error(target=target, prediction=prediction).item(),
+        "mae": _mean_absolute_error(target=target, prediction=prediction).item(),
+        "psnr": _peak_signal_noise_ratio(target=target, prediction=prediction).item(),
+        "psnr_eps": _peak_signal_noise_ratio(
+            target=target, prediction=prediction, epsilon=sys.float_info.epsilon
+        ).item(),
+        "psnr_01": _peak_signal_noise_ratio(
+            target=target, prediction=prediction, data_range=(0, 1)
+        ).item(),
+        "psnr_01_eps": _peak_signal_noise_ratio(
+            target=target, prediction=prediction, data_range=(0, 1),
+            epsilon=sys.float_info.epsilon,
+        ).item(),
+    }
 
-def main():
-    """Main function."""
-    args = get_args()
-    with tempfile.TemporaryDirectory() as tmp_pred_dir, \
-         tempfile.TemporaryDirectory() as tmp_gold_dir, \
-         tempfile.TemporaryDirectory() as tmp_mask_dir:
 
-        preds = utils.inspect_archive(args.predictions_file, path=tmp_pred_dir)
-        utils.inspect_archive(args.goldstandard_file, path=tmp_gold_dir, pattern="t1n")
-        utils.inspect_archive(args.healthy_masks_file, path=tmp_mask_dir)
+def case_files(pred, label, pred_dir, gold_dir, mask_dir):
+    """
+    Return the scan identifier of a prediction, and the files to score it
+    with: {"pred", "healthy_mask", "ref_t1n", "voided_t1n": path}.
+    """
+    scan_id = re.search(r"\d{5}-\d{3}", pred).group()
+    identifier = f"{label}-{scan_id}"
+    return identifier, {
+        "pred": os.path.join(pred_dir, pred),
+        "healthy_mask": os.path.join(mask_dir, f"{identifier}-mask-healthy.nii.gz"),
+        "ref_t1n": os.path.join(gold_dir, f"{identifier}-t1n.nii.gz"),
+        "voided_t1n": os.path.join(mask_dir, f"{identifier}-t1n-voided.nii.gz"),
+    }
 
-        results = score(
-            preds, args.label,
-            pred_dir=tmp_pred_dir,
-            gold_dir=tmp_gold_dir,
-            mask_dir=tmp_mask_dir,
+
+def score_case(pred, label, pred_dir=PRED_DIR, gold_dir=GOLD_DIR, mask_dir=MASK_DIR,
+               cache_refs=False, slab_size=None):
+    """Compute and return the scan identifier and scores for a single scan."""
+    identifier, files = case_files(pred, label, pred_dir, gold_dir, mask_dir)
+    if slab_size:
+        return identifier, calculate_metrics_slabs(**files, slab_size=slab_size)
+    return identifier, calculate_metrics(**files, cache_refs=cache_refs)
+
+
+def score_batch(preds, label, pred_dir=PRED_DIR, gold_dir=GOLD_DIR, mask_dir=MASK_DIR,
+                cache_refs=False):
+    """
+    Compute and return the scan identifiers and scores for a batch of scans.
+
+    The volumes of all scans in the batch are decoded concurrently (gzip
+    decompression releases the GIL), and each scan is scored as soon as
+    its volumes are ready.
+    """
+    from inpainting.challenge_metrics_2023 import generate_metrics
+
+    cases = [case_files(pred, label, pred_dir, gold_dir, mask_dir) for pred in preds]
+    with ThreadPoolExecutor(max_workers=len(cases)) as executor:
+        volumes = executor.map(
+            lambda files: load_volumes(**files, cache_refs=cache_refs),
+            [files for _, files in cases],
         )
+        return [
+            (identifier, generate_metrics(**case_volumes))
+            for (identifier, _), case_volumes
+            in zip(cases, volumes)
+        ]
+
+
+def batch_size(memory_budget=None):
+    """
+    Return how many scans to decode at once within memory_budget (in GB),
+    or 1 without a budget.
+    """
+    if memory_budget is None:
+        return 1
+    return max(1, int(memory_budget * 1024**3 // CASE_MEMORY_BYTES))
+
+
+def case_key(pred, label, pred_dir, gold_dir, mask_dir):
+    """
+    Return a key identifying the scores of a scan: its ID, the contents of
+    its files, and the versions of the metric implementations.
+    """
+    from importlib.metadata import version
+
+    identifier, files = case_files(pred, label, pred_dir, gold_dir, mask_dir)
+    versions = ",".join(f"{pkg}=={version(pkg)}" for pkg in METRICS_PACKAGES)
+    return utils.content_key(f"{identifier}:{versions}", *files.values())
+
+
+def to_frame(scores):
+    """
+    Collect (scan identifier, metrics) pairs, as returned by score_case,
+    into a DataFrame of per-scan scores, sorted by scan identifier.
+    """
+    import pandas as pd
+
+    return pd.DataFrame(
+        [metrics for _, metrics in scores],
+        index=pd.Index([identifier for identifier, _ in scores], name="scan_id"),
+    ).sort_values(by="scan_id")
+
+
+def _score_in_process(pred_lst, args, batch, on_result):
+    """
+    Score scans in this process, `batch` at a time, passing each result to
+    on_result() as soon as it is ready. Returns the scans that failed to
+    score; the scans of a failing batch are retried one at a time to find
+    the one(s) actually at fault.
+    """
+    failed = []
+    for start in range(0, len(pred_lst), batch):
+        preds = pred_lst[start:start + batch]
+        try:
+            if len(preds) == 1:
+                results = [score_case(preds[0], *args)]
+            else:
+                results = score_batch(preds, *args[:5])
+        except Exception as err:
+            if len(preds) > 1:
+                failed += _score_in_process(preds, args, 1, on_result)
+            else:
+                print(f"Failed to score {preds[0]}: {err!r}", file=sys.stderr)
+                failed += preds
+            continue
+        for pred, result in zip(preds, results):
+            on_result(pred, result)
+    return failed
+
+
+def _score_in_pool(cases, workers, on_result):
+    """
+    Score scans in a process pool, given as {case: score_case arguments},
+    passing each result to on_result() as soon as it is ready. Returns the
+    cases whose worker process died before returning a result, and the
+    cases that failed to score.
+    """
+    broken, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(score_case, *args): case for case, args in cases.items()
+        }
+        for future in as_completed(futures):
+            case = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken.append(case)
+                continue
+            except Exception as err:
+                print(f"Failed to score {case}: {err!r}", file=sys.stderr)
+                failed.append(case)
+                continue
+            on_result(case, result)
+    return broken, failed
+
+
+def score_in_pool(cases, workers, on_result):
+    """
+    Score scans in a pool of `workers` processes, given as {case: arguments
+    of score_case}, passing each result to on_result(case, result) as soon
+    as it is ready. Returns the cases that failed to score.
+
+    A crashed worker (e.g. OOM kill) breaks the whole pool, so the scans it
+    took down are retried one at a time, to find the one(s) actually at
+    fault.
+    """
+    broken, failed = _score_in_pool(cases, workers, on_result)
+    for case in broken:
+        died, errored = _score_in_pool({case: cases[case]}, 1, on_result)
+        if died:
+            print(f"Failed to score {case}: worker process died", file=sys.stderr)
+        failed += died + errored
+    return failed
+
+
+def score(pred_lst, label, pred_dir=PRED_DIR, gold_dir=GOLD_DIR, mask_dir=MASK_DIR,
+          workers=1, cache_refs=False, batch=1, checkpoint_file=None,
+          memo_dir=None, slab_size=None):
+    """
+    Compute and return scores for each scan.
+
+    Scans are decoded and scored `batch` at a time. With `workers` > 1,
+    scans are instead scored concurrently in a process pool. Either way, a
+    scan that fails to score does not stop the others from being scored,
+    but the run then fails with a RuntimeError listing every such scan.
+
+    With `cache_refs`, decoded reference volumes are kept next to the
+    extracted references and reused by later runs (see read_reference).
+
+    With `checkpoint_file`, the scores of each scan are recorded in that
+    file as soon as they are computed, keyed by the scan ID, the contents
+    of its files and the metric versions (see case_key). Scans already
+    recorded there, e.g. by an interrupted earlier run, are not scored
+    again. `memo_dir` works the same way, but is meant to be shared across
+    submissions, so that identical predictions are only ever scored once.
+
+    With `slab_size`, each scan is instead decoded and scored that many
+    slices at a time (see calculate_metrics_slabs), one scan at a time
+    per worker.
+    """
+    args = (label, pred_dir, gold_dir, mask_dir, cache_refs, slab_size)
+    scores, keys = {}, {}
+    if checkpoint_file or memo_dir:
+        done = utils.load_checkpoints(checkpoint_file) if checkpoint_file else {}
+        for pred in pred_lst:
+            key = keys[pred] = case_key(pred, label, pred_dir, gold_dir, mask_dir)
+            result = done.get(key)
+            if result is None and memo_dir:
+                result = utils.memo_get(memo_dir, key)
+            if result is not None:
+                scores[pred] = tuple(result)
+    pending = [pred for pred in pred_lst if pred not in scores]
+
+    def on_result(pred, result):
+        scores[pred] = result
+        if checkpoint_file:
+            utils.save_checkpoint(checkpoint_file, keys[pred], result)
+        if memo_dir:
+            utils.memo_put(memo_dir, keys[pred], result)
+
+    if workers <= 1:
+        failed = _score_in_process(pending, args, 1 if slab_size else batch, on_result)
+    else:
+        failed = score_in_pool(
+            {pred: (pred, *args) for pred in pending}, workers, on_result
+        )
+
+    if failed:
+        raise RuntimeError(failed_message(sorted(
+            case_files(pred, label, pred_dir, gold_dir, mask_dir)[0]
+            for pred in failed
+        )))
+    if not scores:
+        raise RuntimeError("None of the predictions could be scored.")
+    return to_frame(list(scores.values()))
+
+
+def summarize(results):
+    """
+    Append summary statistics to the per-scan scores. Returns them, along
+    with the submission's overall scores.
+    """
+    import pandas as pd
 
     cases_evaluated = len(results.index)
 
@@ -118,38 +548,111 @@ def main():
     )
     results = pd.concat([results, metrics])
 
-    results.to_csv("all_scores.csv")
-    syn = synapseclient.Synapse(configPath=args.synapse_config)
-    syn.login(silent=True)
-    csv = synapseclient.File("all_scores.csv", parent=args.parent_id)
-    csv = syn.store(csv)
+    res_dict = {
+        **results.loc["mean"].rename(
+            {
+                "mse": "mse_mean",
+                "psnr": "psnr_mean",
+                "psnr_01": "psnr_01_mean",
+                "ssim": "ssim_mean",
+            }
+        ),
+        **results.loc["std"].rename(
+            {
+                "mse": "mse_std",
+                "psnr": "psnr_std",
+                "psnr_01": "psnr_01_std",
+                "ssim": "ssim_std",
+            }
+        ),
+        "cases_evaluated": cases_evaluated,
+    }
+    res_dict = {k: v for k, v in res_dict.items() if not pd.isna(v)}
+    return results, res_dict
+
+
+def score_submission(preds, label, pred_dir, gold_dir, mask_dir, upload,
+                     parent_id, timings, **kwargs):
+    """
+    Score extracted predictions (see score, which gets `kwargs`), and upload
+    their scores as all_scores.csv. Returns the results for annotations,
+    with the uploaded file as a future (see write_results).
+    """
+    with utils.timed(timings, "score"):
+        results = score(
+            preds, label, pred_dir=pred_dir, gold_dir=gold_dir,
+            mask_dir=mask_dir, **kwargs
+        )
+
+    with utils.timed(timings, "summarize"):
+        results, res_dict = summarize(results)
+        results.to_csv("all_scores.csv")
+    return {
+        **res_dict,
+        "submission_scores": upload("all_scores.csv", parent_id),
+        "submission_status": "SCORED",
+    }
+
+
+def failed_message(failed):
+    """Return the error listing the scans that could not be scored."""
+    return f"{len(failed)} scan(s) could not be scored: {', '.join(failed)}"
+
+
+def write_results(results, output):
+    """Write the results for annotations, once their files are uploaded."""
+    with open(output, "w") as out:
+        json.dump({
+            key: value.result().id if isinstance(value, Future) else value
+            for key, value in results.items()
+        }, out)
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    timings = {}
+
+    # Log in and upload in the background, while scans are being scored.
+    with uploader.pipeline(
+        args.synapse_config, args.synapse_endpoint, timings=timings
+    ) as upload:
+        with utils.profiled(args.profile), \
+             tempfile.TemporaryDirectory() as tmp_pred_dir, \
+             tempfile.TemporaryDirectory() as tmp_gold_dir, \
+             tempfile.TemporaryDirectory() as tmp_mask_dir:
+
+            with utils.timed(timings, "extract"):
+                preds = utils.inspect_archive(args.predictions_file, path=tmp_pred_dir)
+                gold_dir, _ = utils.extract_cached(
+                    args.goldstandard_file, tmp_gold_dir, args.cache_dir, pattern="t1n"
+                )
+                mask_dir, _ = utils.extract_cached(
+                    args.healthy_masks_file, tmp_mask_dir, args.cache_dir
+                )
+
+            results = score_submission(
+                preds, args.label, tmp_pred_dir, gold_dir, mask_dir, upload,
+                args.parent_id, timings,
+                workers=args.workers,
+                cache_refs=bool(args.cache_dir),
+                batch=batch_size(args.memory_budget),
+                checkpoint_file=args.checkpoint_file,
+                memo_dir=args.memo_dir,
+                slab_size=args.slab_size,
+            )
+
+        # Timings (and profile) are kept out of the participant's folder.
+        # Uploads still in progress at this point are left out of them.
+        utils.write_timings(args.timings_file, timings)
+        if args.private_parent_id:
+            upload(args.timings_file, args.private_parent_id)
+            if args.profile:
+                upload(args.profile, args.private_parent_id)
 
     # Results file for annotations.
-    with open(args.output, "w") as out:
-        res_dict = {
-            **results.loc["mean"].rename(
-                {
-                    "mse": "mse_mean",
-                    "psnr": "psnr_mean",
-                    "psnr_01": "psnr_01_mean",
-                    "ssim": "ssim_mean",
-                }
-            ),
-            **results.loc["std"].rename(
-                {
-                    "mse": "mse_std",
-                    "psnr": "psnr_std",
-                    "psnr_01": "psnr_01_std",
-                    "ssim": "ssim_std",
-                }
-            ),
-            "cases_evaluated": cases_evaluated,
-            "submission_scores": csv.id,
-            "submission_status": "SCORED",
-        }
-        res_dict = {k: v for k, v in res_dict.items() if not pd.isna(v)}
-        json.dump(res_dict, out)
+    write_results(results, args.output)
 
 
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
@@ -0,0 +1,74 @@
+"""Tests for score.py; run with `python -m unittest` from this directory,
+with evaluation/ on PYTHONPATH."""
+
+import os
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+import score
+import utils
+
+LABEL = "BraTS-GLI"
+SHAPE = (24, 24, 24)
+
+
+def _save(path, data):
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+
+
+class ScoreFailuresTest(unittest.TestCase):
+    """A scan that fails to score fails the run, however scans are scored."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dirs = {}
+        for name in ("pred_dir", "gold_dir", "mask_dir"):
+            self.dirs[name] = os.path.join(tmp.name, name)
+            os.mkdir(self.dirs[name])
+
+        rng = np.random.default_rng(0)
+        mask = np.zeros(SHAPE, dtype=np.uint8)
+        mask[8:16, 8:16, 8:16] = 1
+        self.preds = []
+        for case in range(3):
+            identifier = f"{LABEL}-{case:05d}-000"
+            ref = rng.random(SHAPE, dtype=np.float32)
+            _save(os.path.join(self.dirs["gold_dir"], f"{identifier}-t1n.nii.gz"), ref)
+            _save(os.path.join(self.dirs["mask_dir"], f"{identifier}-t1n-voided.nii.gz"),
+                  ref * (1 - mask))
+            _save(os.path.join(self.dirs["mask_dir"], f"{identifier}-mask-healthy.nii.gz"),
+                  mask)
+            pred = f"{identifier}-t1n-inference.nii.gz"
+            _save(os.path.join(self.dirs["pred_dir"], pred),
+                  ref + rng.normal(0, 0.1, SHAPE).astype(np.float32))
+            self.preds.append(pred)
+
+        # The middle scan cannot be decoded.
+        with open(os.path.join(self.dirs["pred_dir"], self.preds[1]), "wb") as out:
+            out.write(b"not a NIfTI file")
+
+    def _score_error(self, **kwargs):
+        with self.assertRaises(RuntimeError) as raised:
+            score.score(self.preds, LABEL, **self.dirs, **kwargs)
+        return str(raised.exception)
+
+    def test_serial_and_pooled_runs_fail_alike(self):
+        expected = score.failed_message([f"{LABEL}-00001-000"])
+        self.assertEqual(self._score_error(), expected)
+        self.assertEqual(self._score_error(batch=3), expected)
+        self.assertEqual(self._score_error(workers=2), expected)
+
+    def test_other_scans_are_still_checkpointed(self):
+        for kwargs in ({}, {"workers": 2}):
+            with self.subTest(**kwargs), tempfile.TemporaryDirectory() as tmp:
+                checkpoint_file = os.path.join(tmp, "checkpoints.jsonl")
+                self._score_error(checkpoint_file=checkpoint_file, **kwargs)
+                self.assertEqual(len(utils.load_checkpoints(checkpoint_file)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
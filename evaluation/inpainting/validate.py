@@ -6,12 +6,11 @@ Predictions file must be a tarball or zipped archive of NIfTI files
 """
 
 import os
-import re
 import argparse
 import json
 
-import nibabel as nib
 import utils
+import worker
 
 DIM = (240, 240, 155)
 ORIGIN = [
@@ -21,6 +20,9 @@ ORIGIN = [
     [0.0, 0.0, 0.0, 1.0],
 ]
 
+# Substring of the healthy masks in the masks archive, one per scan.
+GOLD_PATTERN = "mask-healthy"
+
 
 def get_args():
     """Set up command-line interface and get arguments."""
@@ -38,15 +40,25 @@ def get_args():
                         default="(\d{5}-\d{3})")
     parser.add_argument("--gold_pattern", type=str,
                         default="(\d{5}-\d{3})-seg")
+    parser.add_argument("--header_only", action="store_true",
+                        help="Check NIfTI headers straight from the archive "
+                             "instead of extracting it to --tmp_dir.")
+    parser.add_argument("--gold_manifest", type=str, default=None,
+                        help="Manifest of the goldstandard (see "
+                             "gold_manifest.py); defaults to "
+                             "<goldstandard_file>.manifest.json if present.")
+    parser.add_argument("--timings_file", type=str, default=None,
+                        help="File to record the time and memory used by "
+                             "each stage in.")
     return parser.parse_args()
 
 
-def _check_header(img):
-    """Check if img has dimension: 240x240x155 and origin: [0, -239, 0]."""
+def _check_header(header):
+    """Check if header has dimension: 240x240x155 and origin: [0, -239, 0]."""
     error = ""
     if (
-        img.header.get_data_shape() != DIM
-        or not (img.header.get_qform() == ORIGIN).all()
+        header.get_data_shape() != DIM
+        or not (header.get_qform() == ORIGIN).all()
     ):
         error = (
             "One or more predictions is not a NIfTI file with "
@@ -55,84 +67,98 @@ def _check_header(img):
     return error
 
 
-def check_file_contents(img, parent):
-    """Check that the file can be opened as NIfTI."""
+def check_file_contents(img, parent, headers=None):
+    """
+    Check that the file can be opened as NIfTI. If `headers` is given, the
+    already-parsed header of the file is checked instead of the file itself.
+    """
+    error = "One or more predictions cannot be opened as a NIfTI file."
+    if headers is not None:
+        header = headers.get(img)
+        return error if header is None else _check_header(header)
+    import nibabel as nib
+
     try:
         img = nib.load(os.path.join(parent, img))
-        return _check_header(img)
+        return _check_header(img.header)
     except nib.filebasedimages.ImageFileError:
-        return "One or more predictions cannot be opened as a NIfTI file."
+        return error
 
 
-def validate_file_format(preds, parent):
+def validate_file_format(preds, parent, headers=None):
     """Check that all files are NIfTI files (*.nii.gz)."""
     error = []
     if all(pred.endswith(".nii.gz") for pred in preds):
         # Ensure that all file contents are NIfTI with correct params.
-        if not all((res := check_file_contents(pred, parent)) == "" for pred in preds):
-            error = [res]
+        report = {
+            pred: res
+            for pred in preds
+            if (res := check_file_contents(pred, parent, headers))
+        }
+        error = utils.summarize_report(report)
     else:
         error = ["Not all files in the archive are NIfTI files (*.nii.gz)."]
     return error
 
 
-def validate_filenames(preds, golds, pred_pattern, gold_pattern):
-    """Check that every NIfTI filename follows the given pattern."""
+def validate_filenames(preds, golds, pred_pattern, gold_pattern, manifest=None):
+    """
+    Check that every NIfTI filename follows the given pattern. The case IDs
+    of the goldstandard are taken from its manifest, if given.
+    """
     error = []
-    try:
-        scan_ids = [
-            re.search(fr"{pred_pattern}\.nii\.gz$", pred).group(1)
-            for pred
-            in preds
-        ]
+    gold_case_ids = utils.match_gold_case_ids(golds, gold_pattern, manifest)
+    report = utils.check_case_ids(
+        preds, pred_pattern, set(gold_case_ids.values())
+    )
+    if report["nonconforming"]:
+        error.append(
+            "Not all filenames in the archive follow the expected "
+            "naming format. Please check the Submission Tutorial "
+            "of the task you're submitting to for more details. "
+            f"Unexpected filenames: {', '.join(sorted(report['nonconforming']))}"
+        )
 
-        # Check that all case IDs are unique.
-        if len(set(scan_ids)) != len(scan_ids):
-            error.append("Duplicate predictions found for one or more cases.")
+    # Check that all case IDs are unique.
+    if report["duplicate"]:
+        error.append(
+            "Duplicate predictions found for one or more cases: "
+            f"{', '.join(sorted(report['duplicate']))}"
+        )
 
-        # Check that case IDs are known (e.g. has corresponding gold file).
-        gold_case_ids = {
-            re.search(fr"{gold_pattern}\.nii\.gz$", gold).group(1)
-            for gold
-            in golds
-        }
-        unknown_ids = set(scan_ids) - gold_case_ids
-        if unknown_ids:
-            error.append(f"Unknown scan IDs found: {', '.join(sorted(unknown_ids))}")
-    except AttributeError:
-        error = [
-            (
-                "Not all filenames in the archive follow the expected "
-                "naming format. Please check the Submission Tutorial "
-                "of the task you're submitting to for more details."
-            )
-        ]
+    # Check that case IDs are known (e.g. has corresponding gold file).
+    if report["unknown"]:
+        error.append(f"Unknown scan IDs found: {', '.join(sorted(report['unknown']))}")
     return error
 
 
-def main():
-    """Main function."""
-    args = get_args()
+def validate_predictions(preds, golds, parent, pred_pattern, gold_pattern,
+                         timings, headers=None, manifest=None):
+    """
+    Run all checks on the predictions (extracted to `parent`, unless
+    `headers` is given), against the goldstandard files `golds` (listed in
+    `manifest`, if given). Returns the reasons they are invalid, if any.
+    """
+    if not preds:
+        return [
+            "Submission must be a tarball or zipped archive "
+            "containing at least one NIfTI file."
+        ]
     invalid_reasons = []
-
-    entity_type = args.entity_type.split(".")[-1]
-    if entity_type != "FileEntity":
-        invalid_reasons.append(f"Submission must be a File, not {entity_type}.")
-    else:
-        preds = utils.inspect_archive(args.predictions_file, path=args.tmp_dir)
-        golds = utils.inspect_archive(
-            args.goldstandard_file, extract=False, pattern="mask-healthy"
+    with utils.timed(timings, "check_files"):
+        invalid_reasons.extend(validate_file_format(preds, parent, headers))
+    with utils.timed(timings, "check_filenames"):
+        invalid_reasons.extend(
+            validate_filenames(preds, golds, pred_pattern, gold_pattern, manifest)
         )
-        if preds:
-            invalid_reasons.extend(validate_file_format(preds, args.tmp_dir))
-            invalid_reasons.extend(
-                validate_filenames(preds, golds, args.pred_pattern, args.gold_pattern)
-            )
-        else:
-            invalid_reasons.append(
-                "Submission must be a tarball or zipped archive "
-                "containing at least one NIfTI file."
-            )
+    return invalid_reasons
+
+
+def write_results(invalid_reasons, output=None):
+    """
+    Write the validation status and errors as JSON to `output` (or print
+    them). Returns the status.
+    """
     status = "INVALID" if invalid_reasons else "VALIDATED"
     invalid_reasons = "\n".join(invalid_reasons)
 
@@ -144,12 +170,45 @@ def main():
         "submission_errors": invalid_reasons
     })
 
-    if args.output:
-        with open(args.output, "w") as out:
+    if output:
+        with open(output, "w") as out:
             out.write(res)
     else:
         print(res)
+    return status
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    invalid_reasons = []
+    timings = {}
+
+    entity_type = args.entity_type.split(".")[-1]
+    if entity_type != "FileEntity":
+        invalid_reasons.append(f"Submission must be a File, not {entity_type}.")
+    else:
+        with utils.timed(timings, "extract"):
+            if args.header_only:
+                headers = utils.read_archive_headers(args.predictions_file)
+                preds = [pred for pred, _ in headers]
+                headers = dict(headers)
+            else:
+                headers = None
+                preds = utils.inspect_archive(args.predictions_file, path=args.tmp_dir)
+        manifest = utils.load_manifest(args.goldstandard_file, args.gold_manifest)
+        golds = utils.list_archive(
+            args.goldstandard_file, pattern=GOLD_PATTERN, manifest=manifest
+        )
+        invalid_reasons = validate_predictions(
+            preds, golds, args.tmp_dir, args.pred_pattern, args.gold_pattern,
+            timings, headers, manifest,
+        )
+    write_results(invalid_reasons, args.output)
+
+    if args.timings_file:
+        utils.write_timings(args.timings_file, timings)
 
 
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Validation and scoring script for BraTS pathology task.
+
+Runs validate.py and then, for a valid submission, score.py in one process,
+instead of as two workflow steps in separate containers: the predictions
+file is read once, and scoring joins the predictions validation checked to
+the goldstandard. Validation results go to --validation_output; scoring
+results go to --output, which holds the validation results instead if the
+submission is invalid.
+"""
+
+import argparse
+import shutil
+
+import score
+import utils
+import validate
+import worker
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parent_id", type=str, required=True)
+    parser.add_argument("-s", "--synapse_config", type=str, default="/.synapseConfig")
+    parser.add_argument(
+        "--synapse_endpoint",
+        type=str,
+        default=None,
+        help="Base URL of the Synapse server to upload to, if not the public one.",
+    )
+    parser.add_argument(
+        "-p", "--predictions_file", type=str, default="/predictions.csv"
+    )
+    parser.add_argument(
+        "-g", "--goldstandard_file", type=str, default="/goldstandard.csv"
+    )
+    parser.add_argument(
+        "-c", "--gandlf_config", type=str, default="/gandlf_config.yaml"
+    )
+    parser.add_argument("-e", "--entity_type", type=str, required=True)
+    parser.add_argument("-o", "--output", type=str, default="results.json")
+    parser.add_argument(
+        "--validation_output", type=str, default="validation_results.json"
+    )
+    parser.add_argument("--subject_id_pattern", type=str, required=True)
+    parser.add_argument("--min_label", type=int, default=0)
+    parser.add_argument("--max_label", type=int, default=5)
+    parser.add_argument("--penalty_label", type=int, default=None)
+    parser.add_argument(
+        "--metrics_engine",
+        choices=["native", "gandlf"],
+        default="native",
+        help="Compute the metrics in-process, or with `gandlf generate-metrics`.",
+    )
+    parser.add_argument(
+        "--timings_file",
+        type=str,
+        default="timings.json",
+        help="File to record the time and memory used by each stage in; it is "
+        "uploaded to the private folder.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    timings = {}
+
+    with utils.timed(timings, "validate"):
+        pred, errors = validate.validate_predictions(
+            args.predictions_file, args.entity_type, args.subject_id_pattern,
+            args.min_label, args.max_label,
+        )
+    status = validate.write_results(errors, args.validation_output)
+
+    if status != "VALIDATED":
+        shutil.copyfile(args.validation_output, args.output)
+        return
+
+    with utils.timed(timings, "prepare_input"):
+        merged = score.merge_predictions(
+            pred,
+            args.goldstandard_file,
+            penalty_label=args.penalty_label,
+            pattern=args.subject_id_pattern,
+        )
+    metrics, metrics_file = score.run_metrics(
+        merged, args.gandlf_config, timings, args.metrics_engine
+    )
+    score.report(
+        metrics, metrics_file, args.synapse_config, args.synapse_endpoint,
+        args.parent_id, args.timings_file, timings, args.output,
+    )
+
+
+if __name__ == "__main__":
+    worker.run(main, __file__)
@@ -8,14 +8,22 @@ Run classification computation and return:
   - F1
   - Sensitivity
   - Specificity
+
+Metrics are computed in-process by default; `--metrics_engine gandlf` runs
+`gandlf generate-metrics` instead. The metrics file uploaded to the private
+folder is GaNDLF's full output whenever GaNDLF runs, and otherwise only
+holds the metrics above.
 """
 
 import argparse
+import ast
 import json
 import subprocess
+import sys
 
-import pandas as pd
-import synapseclient
+import uploader
+import utils
+import worker
 
 METRICS_TO_RETURN = [
     "mcc",
@@ -32,6 +40,12 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--parent_id", type=str, required=True)
     parser.add_argument("-s", "--synapse_config", type=str, default="/.synapseConfig")
+    parser.add_argument(
+        "--synapse_endpoint",
+        type=str,
+        default=None,
+        help="Base URL of the Synapse server to upload to, if not the public one.",
+    )
     parser.add_argument(
         "-p", "--predictions_file", type=str, default="/predictions.csv"
     )
@@ -44,6 +58,25 @@ def get_args():
     parser.add_argument("-o", "--output", type=str, default="results.json")
     parser.add_argument("--penalty_label", type=int, default=None)
     parser.add_argument("--subject_id_pattern", type=str, required=True)
+    parser.add_argument(
+        "--metrics_engine",
+        choices=["native", "gandlf"],
+        default="native",
+        help="Compute the metrics in-process, or with `gandlf generate-metrics`.",
+    )
+    parser.add_argument(
+        "--check_parity",
+        action="store_true",
+        help="Also run GaNDLF, and fail if its metrics differ from the native ones.",
+    )
+    parser.add_argument("--parity_tolerance", type=float, default=1e-5)
+    parser.add_argument(
+        "--timings_file",
+        type=str,
+        default="timings.json",
+        help="File to record the time and memory used by each stage in; it is "
+        "uploaded to the private folder.",
+    )
     return parser.parse_args()
 
 
@@ -69,14 +102,20 @@ def _extract_value_by_pattern(col, pattern_to_extract):
     return col.str.extract(pattern_to_extract)
 
 
-def create_gandlf_input(pred_file, gold_file, out_file, penalty_label, pattern):
+def merge_predictions(pred_file, gold_file, penalty_label, pattern):
     """
-    Create 3-col CSV file to use as input to GaNDLF.
+    Return the predictions joined to the goldstandard, as a 3-col DataFrame
+    of SubjectID, Target and Prediction. `pred_file` may also be the
+    predictions as a DataFrame already.
     """
+    import pandas as pd
 
     # Extract only the filename from SubjectID for easier joins.
     filename_pattern = rf"({pattern})"
-    pred = pd.read_csv(pred_file)
+    if isinstance(pred_file, pd.DataFrame):
+        pred = pred_file.copy()
+    else:
+        pred = pd.read_csv(pred_file)
     pred["SubjectID"] = _extract_value_by_pattern(
         pred.loc[:, "SubjectID"], filename_pattern
     )
@@ -95,34 +134,211 @@ def create_gandlf_input(pred_file, gold_file, out_file, penalty_label, pattern):
         res["Prediction"] = res["Prediction"].astype(int)
     else:
         res = gold.merge(pred, on="SubjectID")
+    return res
+
+
+def create_gandlf_input(pred_file, gold_file, out_file, penalty_label, pattern):
+    """
+    Create 3-col CSV file to use as input to GaNDLF.
+    """
+    res = merge_predictions(pred_file, gold_file, penalty_label, pattern)
     res.to_csv(out_file, index=False)
 
 
-def main():
-    """Main function."""
-    args = get_args()
+def read_num_classes(config_file):
+    """Return the number of classes of a GaNDLF config, as GaNDLF does."""
+    import yaml
+
+    with open(config_file, encoding="utf-8") as f:
+        model = yaml.safe_load(f)["model"]
+    if "num_classes" in model:
+        return int(model["num_classes"])
+    class_list = model["class_list"]
+    if isinstance(class_list, str):
+        class_list = ast.literal_eval(class_list)
+    return len(class_list)
+
+
+def _safe_divide(num, denom):
+    """Divide elementwise, returning 0 wherever the denominator is 0."""
+    import numpy as np
+
+    num = np.asarray(num, dtype=float)
+    return np.divide(num, denom, out=np.zeros_like(num), where=denom != 0)
+
+
+def gandlf_scores(num_classes):
+    """
+    Return the class probabilities GaNDLF assigns to each predicted label
+    for its AUROC (softmax over the one-hot label, in float32), or None if
+    torch is not installed.
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch.softmax(torch.eye(num_classes), dim=1).numpy()
+
+
+def _auroc_per_class(confmat, scores):
+    """
+    Return the one-vs-rest AUROC of every class, where a case predicted as
+    class j scores scores[j, k] for class k. Ties count as half.
+    """
+    import numpy as np
 
-    gandlf_input_file = "tmp.csv"
-    create_gandlf_input(
-        args.predictions_file,
-        args.goldstandard_file,
-        out_file=gandlf_input_file,
-        penalty_label=args.penalty_label,
-        pattern=args.subject_id_pattern,
+    positives = confmat.T
+    negatives = confmat.sum(axis=0) - positives.T
+    ranks = (
+        (scores[:, None, :] > scores[None, :, :])
+        + 0.5 * (scores[:, None, :] == scores[None, :, :])
     )
+    pairs = np.einsum("ik,ijk,kj->k", positives, ranks, negatives)
+    return _safe_divide(pairs, positives.sum(axis=0) * negatives.sum(axis=1))
+
+
+def compute_metrics(target, prediction, num_classes, scores=None):
+    """
+    Compute METRICS_TO_RETURN for multiclass labels in a single pass.
+
+    Matches what `gandlf generate-metrics` reports (with torchmetrics), but
+    derives every metric from one confusion matrix. As in GaNDLF, the AUROC
+    is computed from the predicted labels only: a case predicted as class j
+    scores scores[j, k] for class k, by default 1 if j == k else 0. GaNDLF
+    uses a float32 softmax of these, whose rounding breaks some of the ties;
+    pass gandlf_scores() to match its AUROC.
+    """
+    import numpy as np
+
+    target = np.asarray(target, dtype=np.int64)
+    prediction = np.asarray(prediction, dtype=np.int64)
+    for labels in (target, prediction):
+        if labels.size and (labels.min() < 0 or labels.max() >= num_classes):
+            raise ValueError(f"Class labels must be in [0, {num_classes - 1}].")
+
+    confmat = np.bincount(
+        target * num_classes + prediction, minlength=num_classes**2
+    ).reshape(num_classes, num_classes)
+    total = confmat.sum()
+    tp = np.diag(confmat)
+    support = confmat.sum(axis=1)
+    predicted = confmat.sum(axis=0)
+    fn = support - tp
+    fp = predicted - tp
+    tn = total - tp - fp - fn
+
+    # Macro averages leave out classes that are neither present nor predicted.
+    present = (tp + fp + fn) > 0
+    recall = _safe_divide(tp, tp + fn)
+    specificity = _safe_divide(tn, tn + fp)
+    f1 = _safe_divide(2 * tp, 2 * tp + fp + fn)
+    if scores is None:
+        scores = np.eye(num_classes)
+    auroc = _auroc_per_class(confmat, scores)
+
+    cov_ytyp = tp.sum() * total - float(support @ predicted)
+    cov_ypyp = float(total) ** 2 - float(predicted @ predicted)
+    cov_ytyt = float(total) ** 2 - float(support @ support)
+    denom = cov_ypyp * cov_ytyt
+
+    return {
+        "mcc": float(cov_ytyp / np.sqrt(denom)) if denom else 0.0,
+        "f1_per_class_average": float(
+            _safe_divide(f1[present].sum(), present.sum())
+        ),
+        "accuracy_global": float(_safe_divide(tp.sum(), total)),
+        "specificity_per_class_weighted": float(
+            _safe_divide(specificity @ support, support.sum())
+        ),
+        "recall_per_class_average": float(
+            _safe_divide(recall[present].sum(), present.sum())
+        ),
+        "auroc_per_class_weighted": float(
+            _safe_divide(auroc @ support, support.sum())
+        ),
+    }
+
+
+def compare_metrics(metrics, reference, tolerance):
+    """Return the metrics that differ from the reference by more than `tolerance`."""
+    import numpy as np
+
+    return {
+        metric: (metrics[metric], reference.get(metric))
+        for metric in METRICS_TO_RETURN
+        if reference.get(metric) is None
+        or not np.isclose(metrics[metric], reference[metric], rtol=0, atol=tolerance)
+    }
+
+
+def run_metrics(merged, gandlf_config, timings, metrics_engine="native",
+                check_parity=False, parity_tolerance=1e-5):
+    """
+    Compute the metrics of the merged predictions (see merge_predictions).
+    Returns the metrics, and the file they were written to: GaNDLF's full
+    output if it ran, otherwise just METRICS_TO_RETURN.
+    """
+    metrics = None
+    if metrics_engine == "native":
+        num_classes = read_num_classes(gandlf_config)
+        if num_classes > 2:
+            with utils.timed(timings, "metrics"):
+                scores = gandlf_scores(num_classes)
+                if scores is None:
+                    print(
+                        "torch is not installed; AUROC may differ from GaNDLF's.",
+                        file=sys.stderr,
+                    )
+                metrics = compute_metrics(
+                    merged["Target"], merged["Prediction"], num_classes, scores
+                )
+            metrics_file = "metrics.json"
+            with open(metrics_file, "w", encoding="utf-8") as out:
+                json.dump(metrics, out)
+        else:
+            # torchmetrics scores binary tasks on the positive class only,
+            # with special cases not mirrored here.
+            print(
+                "Binary classification is only scored with GaNDLF; running it instead.",
+                file=sys.stderr,
+            )
 
-    gandlf_output_file = "gandlf_metrics.json"
-    run_gandlf(args.gandlf_config, gandlf_input_file, gandlf_output_file)
+    if metrics is None or check_parity:
+        gandlf_input_file = "tmp.csv"
+        merged.to_csv(gandlf_input_file, index=False)
+        gandlf_output_file = "gandlf_metrics.json"
+        with utils.timed(timings, "gandlf"):
+            run_gandlf(gandlf_config, gandlf_input_file, gandlf_output_file)
+        with open(gandlf_output_file, encoding="utf-8") as f:
+            reference = json.load(f)
+        if metrics is None:
+            metrics = reference
+        else:
+            mismatches = compare_metrics(metrics, reference, parity_tolerance)
+            if mismatches:
+                raise ValueError(
+                    "Native metrics differ from GaNDLF's (native, GaNDLF): "
+                    f"{mismatches}"
+                )
+        # Keep GaNDLF's per-class and other metrics in the private file.
+        metrics_file = gandlf_output_file
+    return metrics, metrics_file
 
-    # Upload full GaNDLF metrics JSON to the private folder.
-    syn = synapseclient.Synapse(configPath=args.synapse_config)
-    syn.login(silent=True)
-    private_file = synapseclient.File(gandlf_output_file, parent=args.parent_id)
-    private_file = syn.store(private_file)       
 
-    with open(gandlf_output_file, encoding="utf-8") as f, \
-         open(args.output, "w", encoding="utf-8") as out:
-        metrics = json.load(f)
+def report(metrics, metrics_file, synapse_config, synapse_endpoint, parent_id,
+           timings_file, timings, output):
+    """
+    Upload the full metrics, and the timings, to the private folder, and
+    write the results for annotations to `output`.
+    """
+    with utils.timed(timings, "synapse_login"):
+        syn = uploader.login(synapse_config, synapse_endpoint)
+    with utils.timed(timings, f"upload[{metrics_file}]"):
+        private_file = uploader.store(syn, metrics_file, parent_id)
+    utils.write_timings(timings_file, timings)
+    uploader.store(syn, timings_file, parent_id)
+
+    with open(output, "w", encoding="utf-8") as out:
         results = {
             metric: score
             for metric, score in metrics.items()
@@ -138,5 +354,29 @@ def main():
         )
 
 
+def main():
+    """Main function."""
+    args = get_args()
+
+    timings = {}
+
+    with utils.timed(timings, "prepare_input"):
+        merged = merge_predictions(
+            args.predictions_file,
+            args.goldstandard_file,
+            penalty_label=args.penalty_label,
+            pattern=args.subject_id_pattern,
+        )
+
+    metrics, metrics_file = run_metrics(
+        merged, args.gandlf_config, timings, args.metrics_engine,
+        args.check_parity, args.parity_tolerance,
+    )
+    report(
+        metrics, metrics_file, args.synapse_config, args.synapse_endpoint,
+        args.parent_id, args.timings_file, timings, args.output,
+    )
+
+
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
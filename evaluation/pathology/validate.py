@@ -9,8 +9,7 @@ Predictions file must be a 2-col CSV with two columns:
 import argparse
 import json
 
-import pandas as pd
-from cnb_tools import validation_toolkit as vtk
+import worker
 
 EXPECTED_COLS = {"SubjectID": str, "Prediction": int}
 
@@ -29,53 +28,62 @@ def get_args():
     return parser.parse_args()
 
 
-def validate(pred_file, pattern, min_val, max_val):
-    """Validate predictions file against goldstandard."""
+def read_predictions(pred_file):
+    """
+    Read the predictions file. Raises ValueError if it is not a CSV file
+    with the expected columns.
+    """
+    import pandas as pd
+
+    return pd.read_csv(pred_file, usecols=EXPECTED_COLS, dtype=EXPECTED_COLS)
+
+
+def check_predictions(pred, pattern, min_val, max_val):
+    """Check the contents of the predictions, as read by read_predictions."""
+    from cnb_tools import validation_toolkit as vtk
+
     errors = []
-    try:
-        pred = pd.read_csv(
-            pred_file,
-            usecols=EXPECTED_COLS,
-            dtype=EXPECTED_COLS
-        )
-    except ValueError:
+    errors.append(vtk.check_duplicate_keys(pred["SubjectID"]))
+    errors.append(vtk.check_values_range(
+        pred["Prediction"],
+        min_val=min_val,
+        max_val=max_val,
+    ))
+
+    # Check that SubjectIDs contain the filename of the digitized
+    # tissue, including the file extension.
+    if not all(pred["SubjectID"].str.contains(pattern)):
         errors.append(
-            "Submission must be a CSV file with the following "
-            f"colnames and coltypes: {str(EXPECTED_COLS)}"
+            "'SubjectID' values must be the filenames in the "
+            f"validation dataset (regex pattern: {pattern})"
         )
-    else:
-        errors.append(vtk.check_duplicate_keys(pred["SubjectID"]))
-        errors.append(vtk.check_values_range(
-            pred["Prediction"],
-            min_val=min_val,
-            max_val=max_val,
-        ))
-
-        # Check that SubjectIDs contain the filename of the digitized
-        # tissue, including the file extension.
-        if not all(pred["SubjectID"].str.contains(pattern)):
-            errors.append(
-                "'SubjectID' values must be the filenames in the "
-                f"validation dataset (regex pattern: {pattern})"
-            )
     return errors
 
 
-def main():
-    """Main function."""
-    args = get_args()
-
-    entity_type = args.entity_type.split(".")[-1]
+def validate_predictions(pred_file, entity_type, pattern, min_val, max_val):
+    """
+    Validate the predictions file of a submission (of Synapse `entity_type`).
+    Returns the predictions, as read by read_predictions (None if they could
+    not be read), and the reasons they are invalid, if any.
+    """
+    entity_type = entity_type.split(".")[-1]
     if entity_type != "FileEntity":
-        errors = [f"Submission must be a File, not {entity_type}."]
-    else:
-        errors = validate(
-            pred_file=args.predictions_file,
-            pattern=args.subject_id_pattern,
-            min_val=args.min_label,
-            max_val=args.max_label,
-        )
+        return None, [f"Submission must be a File, not {entity_type}."]
+    try:
+        pred = read_predictions(pred_file)
+    except ValueError:
+        return None, [
+            "Submission must be a CSV file with the following "
+            f"colnames and coltypes: {str(EXPECTED_COLS)}"
+        ]
+    return pred, check_predictions(pred, pattern, min_val, max_val)
+
 
+def write_results(errors, output=None):
+    """
+    Write the validation status and errors as JSON to `output` (or print
+    them). Returns the status.
+    """
     invalid_reasons = "\n".join(filter(None, errors))
     status = "INVALID" if invalid_reasons else "VALIDATED"
 
@@ -86,12 +94,26 @@ def main():
         {"submission_status": status, "submission_errors": invalid_reasons}
     )
 
-    if args.output:
-        with open(args.output, "w", encoding="utf-8") as out:
+    if output:
+        with open(output, "w", encoding="utf-8") as out:
             out.write(res)
     else:
         print(res)
+    return status
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    _, errors = validate_predictions(
+        pred_file=args.predictions_file,
+        entity_type=args.entity_type,
+        pattern=args.subject_id_pattern,
+        min_val=args.min_label,
+        max_val=args.max_label,
+    )
+    write_results(errors, args.output)
 
 
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Batch scoring script for BraTS segmentation tasks.
+
+Score several submissions against the same goldstandard in one run, e.g.
+to rescore a whole phase: the goldstandard is extracted only once, and the
+cases of all submissions are evaluated with the BraTS-evaluation library
+in one process pool, rather than a brats-evaluate process per submission.
+Each submission gets its own panoptica_metrics.json, all_scores.csv and
+results.json, the same as score.py writes (without Synapse IDs, as nothing
+is uploaded), in a subdirectory of --output_dir named after its
+predictions file. Spatially mismatching cases are handled the same way as
+in score.py (see --on_mismatch).
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import score
+import utils
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p", "--predictions_files", type=str, nargs="+", required=True
+    )
+    parser.add_argument(
+        "-g", "--goldstandard_file", type=str, default="/goldstandard.zip"
+    )
+    parser.add_argument("-l", "--label", type=str, required=True)
+    parser.add_argument("-o", "--output_dir", type=str, default="batch")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of cases to evaluate concurrently.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache extracted goldstandard files in, across runs.",
+    )
+    parser.add_argument(
+        "--memo_dir",
+        type=str,
+        default=None,
+        help="Directory to memoize metrics of each case in.",
+    )
+    parser.add_argument(
+        "--on_mismatch",
+        choices=["skip", "penalize", "abort"],
+        default="skip",
+        help="Whether to leave out cases whose prediction does not match the "
+        "reference spatially, to score them as missing, or not to score the "
+        "submission at all (see score.py).",
+    )
+    return parser.parse_args()
+
+
+def evaluate_submissions(config, gold_dir, submissions, workers=1, memo_dir=None):
+    """
+    Evaluate several submissions, given as {name: (pred_dir, cases)} (see
+    score.check_spatial), with the cases of all of them in one process pool
+    (see score.evaluate_cases). Returns {name: brats-evaluate JSON}.
+    """
+    evaluated = {
+        name: [(pred_dir, ref, pred) for ref, pred in cases if pred is not None]
+        for name, (pred_dir, cases) in submissions.items()
+    }
+    metrics = score.evaluate_cases(
+        config, gold_dir, [case for cases in evaluated.values() for case in cases],
+        workers, memo_dir=memo_dir,
+    )
+    return {
+        name: {
+            "metrics": [metrics[case] for case in evaluated[name]],
+            "missings": [ref for ref, pred in cases if pred is None],
+        }
+        for name, (_, cases) in submissions.items()
+    }
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    eval_config = score.EVALUATION_CONFIG.get(args.label, args.label.lower())
+    stems = utils.unique_stems(args.predictions_files)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gold_dir, _ = utils.extract_cached(
+            args.goldstandard_file, os.path.join(tmp_dir, score.GT_PARENT_DIR),
+            args.cache_dir,
+        )
+        submissions, mismatches = {}, {}
+        for name, predictions_file in stems.items():
+            pred_dir = os.path.join(tmp_dir, score.PRED_PARENT_DIR, name)
+            utils.inspect_archive(predictions_file, path=pred_dir)
+            cases, mismatches[name] = score.check_spatial(gold_dir, pred_dir)
+            if not (mismatches[name] and args.on_mismatch == "abort"):
+                submissions[name] = (pred_dir, cases)
+
+        metrics = evaluate_submissions(
+            eval_config, gold_dir, submissions, args.workers, args.memo_dir
+        )
+
+    failed = []
+    for name in stems:
+        out_dir = os.path.join(args.output_dir, name)
+        os.makedirs(out_dir, exist_ok=True)
+        metrics_json = os.path.join(out_dir, "panoptica_metrics.json")
+        summary_csv = os.path.join(out_dir, "all_scores.csv")
+        if name in metrics:
+            with open(metrics_json, "w", encoding="utf-8") as out:
+                json.dump(metrics[name], out, indent=4)
+            if mismatches[name]:
+                score.record_mismatches(
+                    metrics_json, mismatches[name], args.on_mismatch
+                )
+            score.run_parse_metrics(
+                args.label, metrics_json, summary_csv, in_process=True
+            )
+
+        if name not in metrics:
+            failed.append(name)
+            res = {
+                "submission_status": "NOT_SCORED",
+                "submission_errors": score.mismatch_error(
+                    mismatches[name], args.on_mismatch
+                ),
+            }
+        elif os.path.isfile(summary_csv):
+            res = {
+                **score.read_mean_metrics(summary_csv),
+                "submission_status": "SCORED",
+                "submission_errors": (
+                    score.mismatch_error(mismatches[name], args.on_mismatch)
+                    if mismatches[name] else None
+                ),
+            }
+        else:
+            failed.append(name)
+            res = {
+                "submission_status": "NOT_SCORED",
+                "submission_errors": "Panoptica scores not available, likely "
+                "due to spatial mismatches",
+            }
+        with open(os.path.join(out_dir, "results.json"), "w", encoding="utf-8") as out:
+            json.dump(res, out)
+        print(f"{name}: {res['submission_status']}")
+
+    if failed:
+        sys.exit(f"No scores for: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
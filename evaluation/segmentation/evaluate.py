@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Validation and scoring script for BraTS segmentation tasks.
+
+Runs validate.py and then, for a valid submission, score.py in one process,
+instead of as two workflow steps in separate containers: the predictions
+and goldstandard archives are extracted once, and scoring works on the
+files validation checked. Validation results go to --validation_output;
+scoring results go to --output, which holds the validation results
+instead if the submission is invalid.
+"""
+
+import argparse
+import shutil
+
+import score
+import uploader
+import utils
+import validate
+import worker
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parent_id", type=str, required=True)
+    parser.add_argument("--private_parent_id", type=str, required=True)
+    parser.add_argument("-s", "--synapse_config", type=str, default="/.synapseConfig")
+    parser.add_argument(
+        "--synapse_endpoint",
+        type=str,
+        default=None,
+        help="Base URL of the Synapse server to upload to, if not the public one.",
+    )
+    parser.add_argument(
+        "-p", "--predictions_file", type=str, default="/predictions.zip"
+    )
+    parser.add_argument(
+        "-g", "--goldstandard_file", type=str, default="/goldstandard.zip"
+    )
+    parser.add_argument("-e", "--entity_type", type=str, required=True)
+    parser.add_argument("-l", "--label", type=str, required=True)
+    parser.add_argument("-o", "--output", type=str, default="results.json")
+    parser.add_argument(
+        "--validation_output", type=str, default="validation_results.json"
+    )
+    parser.add_argument("--pred_pattern", type=str, default="(\\d{5}-\\d{3})")
+    parser.add_argument("--gold_pattern", type=str, default="(\\d{5}-\\d{3})-seg")
+    parser.add_argument(
+        "--labels",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Labels allowed in the predictions, e.g. 0 1 2 3 4; only checked "
+        "if given, as it decompresses every voxel of every prediction.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of files to check concurrently.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache extracted goldstandard files in.",
+    )
+    parser.add_argument(
+        "--in_process",
+        action="store_true",
+        help="Call the BraTS-evaluation library directly instead of its CLIs.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of case groups (or, when the library is called directly, "
+        "cases) to evaluate concurrently.",
+    )
+    parser.add_argument(
+        "--memo_dir",
+        type=str,
+        default=None,
+        help="Directory to memoize metrics of each case in, shared across "
+        "submissions. Implies --in_process.",
+    )
+    parser.add_argument(
+        "--on_mismatch",
+        choices=["skip", "penalize", "abort"],
+        default="skip",
+        help="Whether to leave out cases whose prediction does not match the "
+        "reference in shape, voxel spacing or affine, to score them as "
+        "missing (worst-case metrics), or not to score the submission at all.",
+    )
+    parser.add_argument(
+        "--timings_file",
+        type=str,
+        default="timings.json",
+        help="File to record the time and memory used by each stage in; it is "
+        "uploaded to the private folder.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    timings = {}
+
+    entity_type = args.entity_type.split(".")[-1]
+    if entity_type != "FileEntity":
+        invalid_reasons = [f"Submission must be a File, not {entity_type}."]
+    else:
+        # Extract the goldstandard up front rather than only listing it, as
+        # scoring needs it for every valid submission.
+        with utils.timed(timings, "extract"):
+            preds = utils.inspect_archive(
+                args.predictions_file, path=score.PRED_PARENT_DIR
+            )
+            gold_dir, golds = utils.extract_cached(
+                args.goldstandard_file, score.GT_PARENT_DIR, args.cache_dir
+            )
+        invalid_reasons = validate.validate_predictions(
+            preds, golds, score.PRED_PARENT_DIR, args.label, args.pred_pattern,
+            args.gold_pattern, timings, workers=args.workers, labels=args.labels,
+        )
+    status = validate.write_results(invalid_reasons, args.validation_output)
+
+    if status != "VALIDATED":
+        shutil.copyfile(args.validation_output, args.output)
+        return
+
+    with uploader.pipeline(
+        args.synapse_config, args.synapse_endpoint, timings=timings
+    ) as upload:
+        results = score.score_submission(
+            args.label, gold_dir, score.PRED_PARENT_DIR, upload, args.parent_id,
+            args.private_parent_id, timings, args.in_process, args.shards,
+            memo_dir=args.memo_dir, on_mismatch=args.on_mismatch,
+        )
+        utils.write_timings(args.timings_file, timings)
+        upload(args.timings_file, args.private_parent_id)
+
+    score.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    worker.run(main, __file__)
@@ -1,21 +1,27 @@
 #!/usr/bin/env python3
 """Scoring script for BraTS segmentation tasks.
 
-Uses the BraTS-evaluation package (brats-evaluate + brats-parse-metrics)
-to compute panoptica-based segmentation metrics:
+Uses the BraTS-evaluation package (brats-evaluate + brats-parse-metrics,
+or the same library called in-process) to compute panoptica-based
+segmentation metrics:
   - Lesionwise DSC, HD95, NSD
   - Instance-level TP, FP, FN, F1
 """
 
 from pathlib import Path
 import argparse
+import functools
 import json
+import os
+import re
 import subprocess
+import sys
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 
-import pandas as pd
-import synapseclient
-
+import uploader
 import utils
+import worker
 
 PRED_PARENT_DIR = "pred"
 GT_PARENT_DIR = "ref"
@@ -27,6 +33,20 @@ EVALUATION_CONFIG = {
     "BraTS-GoAT": "GoAT",
 }
 
+# Lesion size/overlap thresholds for parsing BraTS-MET metrics
+METS_THRESHOLDS = {"vol_threshold": 27, "overlap_threshold": 0.2}
+
+# Packages whose versions determine the computed metrics
+METRICS_PACKAGES = ("BraTS_evaluation", "panoptica")
+
+# Case ID pattern brats-evaluate uses to pair references with predictions
+CASE_ID_PATTERN = r"(\d{5}(?:-\d{3})?)"
+
+# Largest difference (in mm) allowed between the voxel spacings or affines
+# of a prediction and its reference: above the float32 precision of NIfTI
+# headers, far below any actual misalignment.
+SPATIAL_TOLERANCE = 1e-3
+
 
 def get_args():
     """Set up command-line interface and get arguments."""
@@ -34,6 +54,12 @@ def get_args():
     parser.add_argument("--parent_id", type=str, required=True)
     parser.add_argument("--private_parent_id", type=str, required=True)
     parser.add_argument("-s", "--synapse_config", type=str, default="/.synapseConfig")
+    parser.add_argument(
+        "--synapse_endpoint",
+        type=str,
+        default=None,
+        help="Base URL of the Synapse server to upload to, if not the public one.",
+    )
     parser.add_argument(
         "-p", "--predictions_file", type=str, default="/predictions.zip"
     )
@@ -42,9 +68,302 @@ def get_args():
     )
     parser.add_argument("-l", "--label", type=str, required=True)
     parser.add_argument("-o", "--output", type=str, default="results.json")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache extracted goldstandard files in.",
+    )
+    parser.add_argument(
+        "--in_process",
+        action="store_true",
+        help="Call the BraTS-evaluation library directly instead of its CLIs.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of case groups (or, when the library is called directly, "
+        "cases) to evaluate concurrently.",
+    )
+    parser.add_argument(
+        "--checkpoint_file",
+        type=str,
+        default=None,
+        help="File to record metrics of each case in, so that a rerun only "
+        "evaluates the cases still missing. Implies --in_process.",
+    )
+    parser.add_argument(
+        "--memo_dir",
+        type=str,
+        default=None,
+        help="Directory to memoize metrics of each case in, shared across "
+        "submissions. Implies --in_process.",
+    )
+    parser.add_argument(
+        "--on_mismatch",
+        choices=["skip", "penalize", "abort"],
+        default="skip",
+        help="Whether to leave out cases whose prediction does not match the "
+        "reference in shape, voxel spacing or affine, to score them as "
+        "missing (worst-case metrics), or not to score the submission at all.",
+    )
+    parser.add_argument(
+        "--timings_file",
+        type=str,
+        default="timings.json",
+        help="File to record the time and memory used by each stage in; it is "
+        "uploaded to the private folder.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="File to dump cProfile stats of the scoring in; it is uploaded "
+        "to the private folder.",
+    )
     return parser.parse_args()
 
 
+def match_cases(ref_path, pred_path):
+    """
+    Pair every reference file with its prediction file (None if missing),
+    the same way brats-evaluate does.
+    """
+    preds = os.listdir(pred_path)
+    cases = []
+    for ref in sorted(f for f in os.listdir(ref_path) if f.endswith(".nii.gz")):
+        pred = None
+        if match := re.search(CASE_ID_PATTERN, ref):
+            suffix = f"{match.group(1)}.nii.gz"
+            pred = next((p for p in preds if p.endswith(suffix)), None)
+        cases.append((ref, pred))
+    return cases
+
+
+def _read_header(path):
+    """Read the NIfTI header of a file, or return None if it has none."""
+    with open(path, "rb") as f:
+        return utils.read_nifti_header(f, compressed=path.endswith(".gz"))
+
+
+def _padded(rows):
+    """Stack rows of different lengths into an array, padded with zeros."""
+    import numpy as np
+
+    width = max((len(row) for row in rows), default=0)
+    return np.array([list(row) + [0] * (width - len(row)) for row in rows], dtype=float)
+
+
+def spatial_mismatches(ref_path, pred_path, cases):
+    """
+    Compare the shape, voxel spacing and affine of every prediction with
+    those of its reference, from their headers alone, so that mismatches
+    are found before panoptica loads any image. Returns a report mapping
+    the reference of every mismatching case to the reason.
+    """
+    import numpy as np
+
+    report, pairs = {}, []
+    for ref, pred in cases:
+        if pred is None:
+            continue
+        headers = (
+            _read_header(os.path.join(pred_path, pred)),
+            _read_header(os.path.join(ref_path, ref)),
+        )
+        if None in headers:
+            report[ref] = "Prediction or reference is not a NIfTI file"
+        else:
+            pairs.append((ref, *headers))
+    if not pairs:
+        return report
+
+    # Predictions' headers first, then the references' in the same order.
+    headers = [h for _, h, _ in pairs] + [h for _, _, h in pairs]
+    shapes = _padded([h.get_data_shape() for h in headers])
+    zooms = _padded([h.get_zooms() for h in headers])
+    affines = np.array([h.get_best_affine() for h in headers])
+    n = len(pairs)
+
+    bad_shape = (shapes[:n] != shapes[n:]).any(axis=1)
+    bad_zooms = (np.abs(zooms[:n] - zooms[n:]) > SPATIAL_TOLERANCE).any(axis=1)
+    bad_affine = (np.abs(affines[:n] - affines[n:]) > SPATIAL_TOLERANCE).any(axis=(1, 2))
+
+    for i in np.flatnonzero(bad_shape | bad_zooms | bad_affine):
+        ref, pred_header, ref_header = pairs[i]
+        if bad_shape[i]:
+            report[ref] = (
+                f"Dimension mismatch: {pred_header.get_data_shape()} vs "
+                f"{ref_header.get_data_shape()}"
+            )
+        elif bad_zooms[i]:
+            report[ref] = (
+                f"Voxel spacing mismatch: {pred_header.get_zooms()} vs "
+                f"{ref_header.get_zooms()}"
+            )
+        else:
+            report[ref] = "Affine mismatch"
+    return report
+
+
+def check_spatial(ref_path, pred_path):
+    """
+    Pair references with predictions (see match_cases) and check them for
+    spatial mismatches (see spatial_mismatches), listing these on stderr.
+    Returns the cases to evaluate, and the mismatches.
+    """
+    cases = match_cases(ref_path, pred_path)
+    mismatches = spatial_mismatches(ref_path, pred_path, cases)
+    for ref, reason in sorted(mismatches.items()):
+        print(f"Spatial mismatch for {ref}: {reason}", file=sys.stderr)
+    return [case for case in cases if case[0] not in mismatches], mismatches
+
+
+def mismatch_error(mismatches, on_mismatch="skip"):
+    """Return the submission error for spatially mismatching cases."""
+    error = "Predictions do not match the references in shape, voxel spacing or affine"
+    if on_mismatch == "skip":
+        error += " and are left out of the scores"
+    elif on_mismatch == "penalize":
+        error += " and are scored as missing"
+    return f"{error}, for: {', '.join(sorted(mismatches))}"
+
+
+def record_mismatches(output_json, report, on_mismatch="skip"):
+    """
+    Record cases that were not evaluated in a brats-evaluate JSON, with the
+    reasons under "spatial_mismatches". With `on_mismatch="skip"`, they are
+    recorded the way brats-evaluate records cases it fails to evaluate, so
+    brats-parse-metrics leaves them out; with "penalize", as missing, the
+    same as cases without a prediction, so it gives them the worst-case
+    metrics.
+    """
+    with open(output_json, encoding="utf-8") as f:
+        results = json.load(f)
+    if on_mismatch == "penalize":
+        results["missings"] = sorted(results["missings"] + list(report))
+    else:
+        results["metrics"] += [
+            {"subject_name": ref, "error": reason} for ref, reason in sorted(report.items())
+        ]
+    results["spatial_mismatches"] = dict(sorted(report.items()))
+    with open(output_json, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=4)
+
+
+@functools.lru_cache(maxsize=None)
+def _evaluator(config):
+    """Load the panoptica evaluator of a config, once per process."""
+    from brats_evaluation import config_path
+    from panoptica import Panoptica_Evaluator
+
+    return Panoptica_Evaluator.load_from_config(str(config_path(config)))
+
+
+def evaluate_case(config, ref_path, pred_path, ref, pred):
+    """Compute the raw panoptica metrics of one case, as brats-evaluate does."""
+    from brats_evaluation import evaluate_single_exam
+
+    return evaluate_single_exam(
+        prediction_filepath=os.path.join(pred_path, pred),
+        reference_filepath=os.path.join(ref_path, ref),
+        subject_identifier=ref,
+        evaluator=_evaluator(config),
+    )
+
+
+def _case_key(config, ref_path, pred_path, ref, pred):
+    """
+    Return a key identifying the metrics of a case: the config, the name of
+    its reference (the subject of its metrics), the contents of its files,
+    and the versions of the metric implementations.
+    """
+    from importlib.metadata import version
+
+    versions = [f"{pkg}=={version(pkg)}" for pkg in METRICS_PACKAGES]
+    return utils.content_key(
+        json.dumps([config, versions, ref]),
+        os.path.join(ref_path, ref),
+        os.path.join(pred_path, pred),
+    )
+
+
+def evaluate_cases(config, ref_path, cases, workers=1, checkpoint_file=None,
+                   memo_dir=None):
+    """
+    Compute the raw panoptica metrics of cases, given as (pred_path, ref,
+    pred) triples, in this process or in a pool of `workers` processes.
+    Returns {case: metrics}.
+
+    With `checkpoint_file`, the metrics of each case are recorded in that
+    file as soon as they are computed (see _case_key for how they are
+    keyed). Cases already recorded there, e.g. by an interrupted earlier
+    run, are not evaluated again. `memo_dir` works the same way, but is
+    meant to be shared across submissions, so that identical predictions
+    are only ever evaluated once.
+    """
+    metrics, keys = {}, {}
+    if checkpoint_file or memo_dir:
+        done = utils.load_checkpoints(checkpoint_file) if checkpoint_file else {}
+        for case in cases:
+            pred_path, ref, pred = case
+            key = keys[case] = _case_key(config, ref_path, pred_path, ref, pred)
+            result = done.get(key)
+            if result is None and memo_dir:
+                result = utils.memo_get(memo_dir, key)
+            if result is not None:
+                metrics[case] = result
+    pending = [case for case in cases if case not in metrics]
+
+    def on_result(case, result):
+        metrics[case] = result
+        if checkpoint_file:
+            utils.save_checkpoint(checkpoint_file, keys[case], result)
+        if memo_dir:
+            utils.memo_put(memo_dir, keys[case], result)
+
+    if workers <= 1:
+        for pred_path, ref, pred in pending:
+            on_result(
+                (pred_path, ref, pred),
+                evaluate_case(config, ref_path, pred_path, ref, pred),
+            )
+        return metrics
+    with ProcessPoolExecutor(max_workers=min(workers, os.cpu_count() or 1)) as executor:
+        futures = {
+            executor.submit(evaluate_case, config, ref_path, pred_path, ref, pred):
+                (pred_path, ref, pred)
+            for pred_path, ref, pred in pending
+        }
+        for future in as_completed(futures):
+            on_result(futures[future], future.result())
+    return metrics
+
+
+def evaluate(config, ref_path, pred_path, output_json, cases=None, workers=1,
+             checkpoint_file=None, memo_dir=None):
+    """
+    Compute raw panoptica metrics with the BraTS-evaluation library, case by
+    case (see evaluate_cases, which gets the other arguments). Writes the
+    same JSON as brats-evaluate, for all cases (see match_cases) unless
+    given, and also returns it.
+    """
+    if cases is None:
+        cases = match_cases(ref_path, pred_path)
+    evaluated = [(pred_path, ref, pred) for ref, pred in cases if pred is not None]
+    metrics = evaluate_cases(
+        config, ref_path, evaluated, workers, checkpoint_file, memo_dir
+    )
+    results = {
+        "metrics": [metrics[case] for case in evaluated],
+        "missings": [ref for ref, pred in cases if pred is None],
+    }
+    with open(output_json, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=4)
+    return results
+
+
 def run_evaluate(config, ref_path, pred_path, output_json):
     """Run brats-evaluate to produce raw panoptica metrics JSON."""
     subprocess.check_call(
@@ -62,16 +381,96 @@ def run_evaluate(config, ref_path, pred_path, output_json):
     )
 
 
-def run_parse_metrics(cohort, json_path, output_csv):
+def merge_metrics(docs):
+    """Merge brats-evaluate JSON documents of disjoint groups of cases."""
+    return {
+        "metrics": [subject for doc in docs for subject in doc["metrics"]],
+        "missings": [subject for doc in docs for subject in doc["missings"]],
+    }
+
+
+def _evaluate_shard(config, ref_path, pred_path, cases, shard_dir):
+    """
+    Run brats-evaluate on a group of cases, by linking their files into
+    separate ref/pred directories. Returns the resulting metrics JSON.
+    """
+    shard_ref = os.path.join(shard_dir, GT_PARENT_DIR)
+    shard_pred = os.path.join(shard_dir, PRED_PARENT_DIR)
+    os.makedirs(shard_ref)
+    os.makedirs(shard_pred)
+    for ref, pred in cases:
+        os.symlink(
+            os.path.abspath(os.path.join(ref_path, ref)),
+            os.path.join(shard_ref, ref),
+        )
+        if pred is not None:
+            os.symlink(
+                os.path.abspath(os.path.join(pred_path, pred)),
+                os.path.join(shard_pred, pred),
+            )
+    shard_json = os.path.join(shard_dir, "metrics.json")
+    run_evaluate(config, shard_ref, shard_pred, shard_json)
+    with open(shard_json, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def split_cases(cases, shards):
+    """Split cases into at most `shards` groups of consecutive cases."""
+    size = max(1, -(-len(cases) // shards))
+    return [cases[i:i + size] for i in range(0, len(cases), size)]
+
+
+def run_evaluate_sharded(config, ref_path, pred_path, output_json, shards,
+                         cases=None):
+    """
+    Same as run_evaluate, but split the cases (all of them, see match_cases,
+    unless given) into `shards` groups that brats-evaluate evaluates
+    concurrently, then merge their metrics into one JSON.
+    """
+    if cases is None:
+        cases = match_cases(ref_path, pred_path)
+    groups = split_cases(cases, shards)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+         ProcessPoolExecutor(max_workers=min(shards, os.cpu_count() or 1)) as executor:
+        futures = [
+            executor.submit(
+                _evaluate_shard,
+                config, ref_path, pred_path, group,
+                os.path.join(tmp_dir, str(i)),
+            )
+            for i, group in enumerate(groups)
+        ]
+        docs = [future.result() for future in futures]
+
+    # Shards hold consecutive cases, so merging them in order gives the same
+    # document as a single brats-evaluate run.
+    results = merge_metrics(docs)
+    with open(output_json, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=4)
+
+
+def run_parse_metrics(cohort, json_path, output_csv, in_process=False):
     """Run brats-parse-metrics to produce per-subject summary CSV."""
     match cohort:
         case "BraTS-MET":
-            subcommand = ["mets", "--vol_threshold", "27", "--overlap_threshold", "0.2"]
+            subcommand = ["mets"]
+            options = METS_THRESHOLDS
         case "BraTS-PED" | "BraTS-GoAT":
             subcommand = ["seg"]
+            options = {}
         case _:
             raise ValueError(f"Unexpected cohort label: {cohort}")
 
+    if in_process:
+        from brats_evaluation import parse_mets_results, parse_seg_results
+
+        parse = parse_mets_results if subcommand == ["mets"] else parse_seg_results
+        parse(json_path=json_path, output_csv_path=output_csv, **options)
+        return
+
+    for option, value in options.items():
+        subcommand += [f"--{option}", str(value)]
     subprocess.check_call(
         [
             "brats-parse-metrics",
@@ -86,59 +485,135 @@ def run_parse_metrics(cohort, json_path, output_csv):
     )
 
 
-def main():
-    """Main function."""
-    args = get_args()
-    eval_config = EVALUATION_CONFIG.get(args.label, args.label.lower())
+def read_mean_metrics(summary_csv):
+    """Return the mean of every metric, from a brats-parse-metrics CSV."""
+    import pandas as pd
+
+    df = pd.read_csv(summary_csv)
+    mean_row = df[df.iloc[:, 0] == "mean"].iloc[0]
+    return {
+        col: float(mean_row[col])
+        for col in df.columns[1:]  # skip subject_id column
+        if pd.notna(mean_row[col])
+    }
 
-    utils.inspect_archive(args.predictions_file, path=PRED_PARENT_DIR)
-    utils.inspect_archive(args.goldstandard_file, path=GT_PARENT_DIR)
 
+def score_submission(label, gold_dir, pred_dir, upload, parent_id,
+                     private_parent_id, timings, in_process=False, shards=1,
+                     checkpoint_file=None, memo_dir=None, on_mismatch="skip"):
+    """
+    Evaluate extracted predictions against the extracted goldstandard, and
+    upload the metrics files as soon as they are final. Returns the results
+    for annotations, with the uploaded files as futures (see write_results).
+
+    Cases whose prediction does not match its reference spatially (see
+    check_spatial) are not evaluated, and are left out of the scores or
+    scored as missing (see record_mismatches), or with
+    `on_mismatch="abort"`, nothing is evaluated at all.
+    """
+    eval_config = EVALUATION_CONFIG.get(label, label.lower())
     metrics_json = "panoptica_metrics.json"
     summary_csv = "all_scores.csv"
 
-    run_evaluate(eval_config, GT_PARENT_DIR, PRED_PARENT_DIR, metrics_json)
-    run_parse_metrics(args.label, metrics_json, summary_csv)
+    with utils.timed(timings, "check_spatial"):
+        cases, mismatches = check_spatial(gold_dir, pred_dir)
+    if mismatches and on_mismatch == "abort":
+        return {
+            "submission_scores": None,
+            "summary_json": None,
+            "submission_status": "NOT_SCORED",
+            "submission_errors": mismatch_error(mismatches, on_mismatch),
+        }
 
-    syn = synapseclient.Synapse(configPath=args.synapse_config)
-    syn.login(silent=True)
+    with utils.timed(timings, "evaluate"):
+        if in_process or checkpoint_file or memo_dir:
+            evaluate(
+                eval_config, gold_dir, pred_dir, metrics_json, cases, shards,
+                checkpoint_file, memo_dir,
+            )
+        elif shards > 1 or mismatches:
+            run_evaluate_sharded(
+                eval_config, gold_dir, pred_dir, metrics_json, shards, cases=cases
+            )
+        else:
+            run_evaluate(eval_config, gold_dir, pred_dir, metrics_json)
+        if mismatches:
+            record_mismatches(metrics_json, mismatches, on_mismatch)
 
     # Upload full panoptica metrics JSON to the private folder.
-    private_file = synapseclient.File(metrics_json, parent=args.private_parent_id)
-    private_file = syn.store(private_file)
+    private_file = upload(metrics_json, private_parent_id)
+
+    with utils.timed(timings, "parse_metrics"):
+        run_parse_metrics(label, metrics_json, summary_csv, in_process)
 
     # Upload per-subject summary CSV to the submitter folder (if available).
     if Path(summary_csv).is_file():
-        csv_file = synapseclient.File(summary_csv, parent=args.parent_id)
-        csv_file = syn.store(csv_file)
-
-        df = pd.read_csv(summary_csv)
-        mean_row = df[df.iloc[:, 0] == "mean"].iloc[0]
-        mean_metrics = {
-            col: float(mean_row[col])
-            for col in df.columns[1:]  # skip subject_id column
-            if pd.notna(mean_row[col])
-        }
+        csv_file = upload(summary_csv, parent_id)
+
+        with utils.timed(timings, "summarize"):
+            mean_metrics = read_mean_metrics(summary_csv)
         status = "SCORED"
-        submission_errors = None
+        submission_errors = (
+            mismatch_error(mismatches, on_mismatch) if mismatches else None
+        )
     else:
         csv_file = None
         mean_metrics = {}
         status = "NOT_SCORED"
         submission_errors = "Panoptica scores not available, likely due to spatial mismatches"
-        
-    with open(args.output, "w", encoding="utf-8") as out:
+
+    return {
+        **mean_metrics,
+        "submission_scores": csv_file,
+        "summary_json": private_file,
+        "submission_status": status,
+        "submission_errors": submission_errors,
+    }
+
+
+def write_results(results, output):
+    """Write the results for annotations, once their files are uploaded."""
+    with open(output, "w", encoding="utf-8") as out:
         json.dump(
             {
-                **mean_metrics,
-                "submission_scores": csv_file.id if csv_file else None,
-                "summary_json": private_file.id,
-                "submission_status": status,
-                "submission_errors": submission_errors,
+                key: value.result().id if isinstance(value, Future) else value
+                for key, value in results.items()
             },
             out,
         )
 
 
+def main():
+    """Main function."""
+    args = get_args()
+    timings = {}
+
+    # Upload each artifact as soon as it is final, while the rest is computed.
+    with uploader.pipeline(
+        args.synapse_config, args.synapse_endpoint, timings=timings
+    ) as upload:
+        with utils.profiled(args.profile):
+            with utils.timed(timings, "extract"):
+                utils.inspect_archive(args.predictions_file, path=PRED_PARENT_DIR)
+                gold_dir, _ = utils.extract_cached(
+                    args.goldstandard_file, GT_PARENT_DIR, args.cache_dir
+                )
+
+            results = score_submission(
+                args.label, gold_dir, PRED_PARENT_DIR, upload, args.parent_id,
+                args.private_parent_id, timings, args.in_process, args.shards,
+                args.checkpoint_file, args.memo_dir, args.on_mismatch,
+            )
+
+        # Timings (and profile) also go to the private folder only. Uploads
+        # still in progress at this point are left out of the timings.
+        utils.write_timings(args.timings_file, timings)
+        upload(args.timings_file, args.private_parent_id)
+        if args.profile:
+            upload(args.profile, args.private_parent_id)
+
+    write_results(results, args.output)
+
+
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
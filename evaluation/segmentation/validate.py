@@ -8,10 +8,11 @@ Predictions file must be a tarball or zipped archive of NIfTI files
 import argparse
 import json
 import os
-import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-import nibabel as nib
 import utils
+import worker
 
 
 def get_args():
@@ -32,97 +33,163 @@ def get_args():
                         default="(\\d{5}-\\d{3})-seg")
     parser.add_argument("-l", "--label",
                         type=str, default="BraTS-GLI")
+    parser.add_argument("--header_only", action="store_true",
+                        help="Check NIfTI headers straight from the archive "
+                             "instead of extracting it to --tmp_dir.")
+    parser.add_argument("--gold_manifest", type=str, default=None,
+                        help="Manifest of the goldstandard (see "
+                             "gold_manifest.py); defaults to "
+                             "<goldstandard_file>.manifest.json if present.")
+    parser.add_argument("--timings_file", type=str, default=None,
+                        help="File to record the time and memory used by "
+                             "each stage in.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of files to check concurrently.")
+    parser.add_argument("--labels", type=int, nargs="+", default=None,
+                        help="Labels allowed in the predictions, e.g. 0 1 2 "
+                             "3 4. Checking them decompresses every voxel of "
+                             "every prediction, so they are only checked if "
+                             "given (and not with --header_only).")
     return parser.parse_args()
 
 
-def _check_dimension(img):
-    if len(img.shape) != 3:
+def _check_dimension(header):
+    if len(header.get_data_shape()) != 3:
         return "One or more predictions is not a 3D image."
     return ""
 
 
-def check_file_contents(img, parent, label):
-    """Check that the file can be opened as NIfTI."""
+def _check_labels(path, labels):
+    import numpy as np
+
     try:
-        img = nib.load(os.path.join(parent, img))
-        return _check_dimension(img)
+        data = utils.load_label_map(path)
+    except ValueError:
+        return "One or more predictions is not an integer label map."
+    except (OSError, EOFError, zlib.error):
+        return "One or more predictions cannot be opened as a NIfTI file."
+    found = np.flatnonzero(np.bincount(data.ravel(), minlength=256))
+    if not np.isin(found, labels).all():
+        return (
+            "One or more predictions contains labels other than the expected "
+            f"ones ({', '.join(map(str, labels))})."
+        )
+    return ""
+
+
+def check_file_contents(img, parent, label, headers=None, labels=None):
+    """
+    Check that the file can be opened as NIfTI and, if `labels` is given,
+    that it only holds those labels. If `headers` is given, the
+    already-parsed header of the file is checked instead of the file itself.
+    """
+    error = "One or more predictions cannot be opened as a " "NIfTI file."
+    if headers is not None:
+        header = headers.get(img)
+        return error if header is None else _check_dimension(header)
+    import nibabel as nib
+
+    path = os.path.join(parent, img)
+    try:
+        img = nib.load(path)
     except nib.filebasedimages.ImageFileError:
-        return "One or more predictions cannot be opened as a " "NIfTI file."
+        return error
+    error = _check_dimension(img.header)
+    if not error and labels is not None:
+        error = _check_labels(path, labels)
+    return error
+
+
+def check_files_contents(preds, parent, label, headers=None, workers=None,
+                         labels=None):
+    """
+    Check the contents of all files concurrently.
+    Returns a report mapping every file that failed a check to the reason.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda pred: check_file_contents(pred, parent, label, headers, labels),
+            preds,
+        )
+        return {pred: res for pred, res in zip(preds, results) if res}
 
 
-def validate_file_format(preds, parent, label):
+def validate_file_format(preds, parent, label, headers=None, workers=None,
+                         labels=None):
     """Check that all files are NIfTI files (*.nii.gz)."""
     error = []
     if all(pred.endswith(".nii.gz") for pred in preds):
         # Ensure that all file contents are NIfTI with correct params.
-        if not all(
-            (res := check_file_contents(pred, parent, label)) == ""
-            for pred
-            in preds
-        ):
-            error = [res]
+        report = check_files_contents(
+            preds, parent, label, headers, workers, labels
+        )
+        error = utils.summarize_report(report)
     else:
         error = ["Not all files in the archive are NIfTI files (*.nii.gz)."]
     return error
 
 
-def validate_filenames(preds, golds, pred_pattern, gold_pattern):
-    """Check that every NIfTI filename follows the given pattern."""
+def validate_filenames(preds, golds, pred_pattern, gold_pattern, manifest=None):
+    """
+    Check that every NIfTI filename follows the given pattern. The case IDs
+    of the goldstandard are taken from its manifest, if given.
+    """
     error = []
-    try:
-        scan_ids = [
-            re.search(fr"{pred_pattern}\.nii\.gz$", pred).group(1)
-            for pred
-            in preds
-        ]
-
-        # Check that all case IDs are unique.
-        if len(set(scan_ids)) != len(scan_ids):
-            error.append("Duplicate predictions found for one or more cases.")
-
-        # Check that case IDs are known (e.g. has corresponding gold file).
-        gold_case_ids = {
-            re.search(fr"{gold_pattern}\.nii\.gz$", gold).group(1)
-            for gold
-            in golds
-        }
-        unknown_ids = set(scan_ids) - gold_case_ids
-        if unknown_ids:
-            error.append(f"Unknown scan IDs found: {', '.join(sorted(unknown_ids))}")
-    except AttributeError:
-        error = [
-            (
-                "Not all filenames in the archive follow the expected "
-                "naming format. Please check the Submission Tutorial "
-                "of the task you're submitting to for more details."
-            )
-        ]
+    gold_case_ids = utils.match_gold_case_ids(golds, gold_pattern, manifest)
+    report = utils.check_case_ids(
+        preds, pred_pattern, set(gold_case_ids.values())
+    )
+    if report["nonconforming"]:
+        error.append(
+            "Not all filenames in the archive follow the expected "
+            "naming format. Please check the Submission Tutorial "
+            "of the task you're submitting to for more details. "
+            f"Unexpected filenames: {', '.join(sorted(report['nonconforming']))}"
+        )
+
+    # Check that all case IDs are unique.
+    if report["duplicate"]:
+        error.append(
+            "Duplicate predictions found for one or more cases: "
+            f"{', '.join(sorted(report['duplicate']))}"
+        )
+
+    # Check that case IDs are known (e.g. has corresponding gold file).
+    if report["unknown"]:
+        error.append(f"Unknown scan IDs found: {', '.join(sorted(report['unknown']))}")
     return error
 
 
-def main():
-    """Main function."""
-    args = get_args()
+def validate_predictions(preds, golds, parent, label, pred_pattern,
+                         gold_pattern, timings, headers=None, workers=None,
+                         labels=None, manifest=None):
+    """
+    Run all checks on the predictions (extracted to `parent`, unless
+    `headers` is given), against the goldstandard files `golds` (listed in
+    `manifest`, if given). Returns the reasons they are invalid, if any.
+    """
+    if not preds:
+        return [
+            "Submission must be a tarball or zipped archive "
+            "containing at least one NIfTI file."
+        ]
     invalid_reasons = []
-
-    entity_type = args.entity_type.split(".")[-1]
-    if entity_type != "FileEntity":
-        invalid_reasons.append(f"Submission must be a File, not {entity_type}.")
-    else:
-        preds = utils.inspect_archive(args.predictions_file, path=args.tmp_dir)
-        golds = utils.inspect_archive(args.goldstandard_file, extract=False)
-        if preds:
-            invalid_reasons.extend(
-                validate_file_format(preds, args.tmp_dir, args.label)
-            )
-            invalid_reasons.extend(
-                validate_filenames(preds, golds, args.pred_pattern, args.gold_pattern)
-            )
-        else:
-            invalid_reasons.append(
-                "Submission must be a tarball or zipped archive "
-                "containing at least one NIfTI file."
-            )
+    with utils.timed(timings, "check_files"):
+        invalid_reasons.extend(
+            validate_file_format(preds, parent, label, headers, workers, labels)
+        )
+    with utils.timed(timings, "check_filenames"):
+        invalid_reasons.extend(
+            validate_filenames(preds, golds, pred_pattern, gold_pattern, manifest)
+        )
+    return invalid_reasons
+
+
+def write_results(invalid_reasons, output=None):
+    """
+    Write the validation status and errors as JSON to `output` (or print
+    them). Returns the status.
+    """
     status = "INVALID" if invalid_reasons else "VALIDATED"
     invalid_reasons = "\n".join(invalid_reasons)
 
@@ -134,12 +201,44 @@ def main():
         "submission_errors": invalid_reasons
     })
 
-    if args.output:
-        with open(args.output, "w") as out:
+    if output:
+        with open(output, "w") as out:
             out.write(res)
     else:
         print(res)
+    return status
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    invalid_reasons = []
+    timings = {}
+
+    entity_type = args.entity_type.split(".")[-1]
+    if entity_type != "FileEntity":
+        invalid_reasons.append(f"Submission must be a File, not {entity_type}.")
+    else:
+        with utils.timed(timings, "extract"):
+            if args.header_only:
+                headers = utils.read_archive_headers(args.predictions_file)
+                preds = [pred for pred, _ in headers]
+                headers = dict(headers)
+            else:
+                headers = None
+                preds = utils.inspect_archive(args.predictions_file, path=args.tmp_dir)
+        manifest = utils.load_manifest(args.goldstandard_file, args.gold_manifest)
+        golds = utils.list_archive(args.goldstandard_file, manifest=manifest)
+        invalid_reasons = validate_predictions(
+            preds, golds, args.tmp_dir, args.label, args.pred_pattern,
+            args.gold_pattern, timings, headers, args.workers, args.labels,
+            manifest,
+        )
+    write_results(invalid_reasons, args.output)
+
+    if args.timings_file:
+        utils.write_timings(args.timings_file, timings)
 
 
 if __name__ == "__main__":
-    main()
+    worker.run(main, __file__)
@@ -0,0 +1,115 @@
+"""Upload scoring outputs to Synapse, shared by the BraTS evaluation scripts.
+
+synapseclient is only imported once something is uploaded, so that scripts
+which never get that far do not pay for importing it.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+import utils
+
+# Number of attempts per upload, and the delay (in seconds) before the
+# first retry; the delay doubles with every retry.
+ATTEMPTS = 4
+BACKOFF = 2
+
+
+def _permanent_errors():
+    """Return the errors that will not go away by retrying."""
+    from synapseclient.core.exceptions import (
+        SynapseAuthenticationError,
+        SynapseAuthorizationError,
+        SynapseNotFoundError,
+    )
+
+    return (
+        SynapseAuthenticationError,
+        SynapseAuthorizationError,
+        SynapseNotFoundError,
+    )
+
+
+def login(synapse_config, endpoint=None):
+    """
+    Log into Synapse and return the client, to be reused for all uploads.
+
+    `endpoint` points the client to another Synapse server than the public
+    one, e.g. a local fake server for testing (http://localhost:8080).
+    """
+    import synapseclient
+
+    endpoints = {}
+    if endpoint:
+        endpoints = {
+            "repoEndpoint": f"{endpoint}/repo/v1",
+            "authEndpoint": f"{endpoint}/auth/v1",
+            "fileHandleEndpoint": f"{endpoint}/file/v1",
+            "portalEndpoint": endpoint,
+        }
+    syn = synapseclient.Synapse(configPath=synapse_config, **endpoints)
+    syn.login(silent=True)
+    return syn
+
+
+def store(syn, path, parent_id, attempts=ATTEMPTS, backoff=BACKOFF):
+    """Upload a file to a Synapse folder, retrying with exponential backoff."""
+    import synapseclient
+
+    permanent_errors = _permanent_errors()
+    for attempt in range(1, attempts + 1):
+        try:
+            return syn.store(synapseclient.File(path, parent=parent_id))
+        except permanent_errors:
+            raise
+        except Exception:
+            if attempt == attempts:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+
+@contextmanager
+def pipeline(synapse_config, endpoint=None, max_workers=4, timings=None):
+    """
+    Upload files in the background while the caller keeps working.
+
+    Logs in right away, and yields a `submit(path, parent_id)` function that
+    starts uploading a file as soon as it is final and returns a future of
+    the stored entity. On exit, waits for all uploads to finish and raises
+    the error of the first failed one, in submission order.
+
+    If `timings` is given, the login and every upload are timed into it
+    (see utils.timed).
+    """
+    def timed(stage):
+        return nullcontext() if timings is None else utils.timed(timings, stage)
+
+    def timed_login():
+        with timed("synapse_login"):
+            return login(synapse_config, endpoint)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    syn = executor.submit(timed_login)
+    futures = []
+
+    def upload(path, parent_id):
+        client = syn.result()
+        with timed(f"upload[{os.path.basename(path)}]"):
+            return store(client, path, parent_id)
+
+    def submit(path, parent_id):
+        future = executor.submit(upload, path, parent_id)
+        futures.append(future)
+        return future
+
+    try:
+        yield submit
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    syn.result()
+    for future in futures:
+        future.result()
@@ -1,10 +1,44 @@
 """Shared utility functions for BraTS evaluation scripts."""
 
+import hashlib
+import io
+import json
 import os
+import re
+import resource
+import shutil
 import stat
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+# Leading bytes of the compressed streams tarfile can read transparently.
+_TAR_COMPRESSION_MAGIC = (
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+)
+
+# Default size limit of an extraction cache directory (see extract_cached).
+CACHE_MAX_BYTES = 50 * 1024**3
+
+# Default size limit of a memo directory (see memo_put).
+MEMO_MAX_BYTES = 1024**3
+
+# Size of the NIfTI-2 header; the NIfTI-1 header (348 bytes) is shorter.
+_NIFTI_HEADER_MAX_SIZE = 540
+
+# Version of the archive manifest format (see build_manifest).
+MANIFEST_VERSION = 2
+
+# Interval (in seconds) between memory usage samples of a timed stage.
+RSS_SAMPLE_INTERVAL = 0.05
 
 
 def _is_hidden(member: str) -> bool:
@@ -13,25 +47,99 @@ def _is_hidden(member: str) -> bool:
     return os.path.split(member)[1].startswith(hidden) or ".idea" in member
 
 
-def _filter_archive_members(members, pattern, is_zip):
-    """Filter out directories, symlinks, and hidden files from archive members."""
-    files_to_extract = []
-    for member in members:
-        member_name = member.filename if is_zip else member.name
-        if is_zip:
-            is_file = (
-                not member.is_dir()
-                and not stat.S_ISLNK(member.external_attr >> 16)
-            )
-        else:
-            is_file = member.isfile()
-        if is_file and not _is_hidden(member_name) and pattern in member_name:
-            if is_zip:
-                member.filename = os.path.basename(member.filename)
-            else:
-                member.name = os.path.basename(member.name)
-            files_to_extract.append(member)
-    return files_to_extract
+def _is_wanted(member, pattern, is_zip):
+    """Check that archive member is a regular, non-hidden file matching pattern."""
+    member_name = member.filename if is_zip else member.name
+    if is_zip:
+        is_file = (
+            not member.is_dir()
+            and not stat.S_ISLNK(member.external_attr >> 16)
+        )
+    else:
+        is_file = member.isfile()
+    return is_file and not _is_hidden(member_name) and pattern in member_name
+
+
+def archive_stem(f):
+    """Return the filename of an archive without its extension(s)."""
+    name = os.path.basename(f)
+    for ext in (".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".tar", ".zip"):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def unique_stems(files):
+    """
+    Map the archive_stem of each file to the file, e.g. to name the
+    outputs of several submissions. Raises ValueError on duplicate stems.
+    """
+    stems = {}
+    for f in files:
+        stem = archive_stem(f)
+        if stem in stems:
+            raise ValueError(f"{f} and {stems[stem]} would have the same outputs; "
+                             "rename one of them.")
+        stems[stem] = f
+    return stems
+
+
+def archive_format(f):
+    """
+    Detect whether `f` is a zip or tar archive from its leading bytes.
+    Returns "zip", "tar", or None.
+    """
+    with open(f, "rb") as fh:
+        head = fh.read(512)
+    if head[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "zip"
+    if head.startswith(_TAR_COMPRESSION_MAGIC) or head[257:262] == b"ustar":
+        return "tar"
+    # Fall back to the (slower) stdlib checks for anything unusual, e.g.
+    # zip files with a prepended stub or pre-POSIX tarballs.
+    if zipfile.is_zipfile(f):
+        return "zip"
+    if tarfile.is_tarfile(f):
+        return "tar"
+    return None
+
+
+def _iter_members(f, pattern=""):
+    """
+    Iterate over matching files of a tar/zipfile in a single pass, yielding
+    (member path, size, fileobj) triples. See iter_archive.
+    """
+    fmt = archive_format(f)
+    if fmt == "zip":
+        with zipfile.ZipFile(f) as zf:
+            for member in zf.infolist():
+                if _is_wanted(member, pattern, is_zip=True):
+                    with zf.open(member) as fh:
+                        yield member.filename, member.file_size, fh
+    elif fmt == "tar":
+        # Stream mode reads the (compressed) archive sequentially exactly
+        # once, instead of seeking back and forth over it.
+        try:
+            tf = tarfile.open(f, mode="r|*")
+        except tarfile.ReadError:
+            # Compressed, but not a tarball (e.g. a single .nii.gz file).
+            return
+        with tf:
+            for member in tf:
+                if _is_wanted(member, pattern, is_zip=False):
+                    yield member.name, member.size, tf.extractfile(member)
+
+
+def iter_archive(f, pattern=""):
+    """
+    Iterate over matching files of a tar/zipfile in a single pass.
+
+    Yields (filename, fileobj) pairs, where filename is the member's
+    basename. fileobj is only valid until the next item is requested, and
+    is not read unless the caller does so.
+    """
+    for path, _, fh in _iter_members(f, pattern):
+        yield os.path.basename(path), fh
 
 
 def inspect_archive(f, extract=True, path=".", pattern=""):
@@ -40,21 +148,471 @@ def inspect_archive(f, extract=True, path=".", pattern=""):
     Returns a list of filenames found in the archive.
     """
     imgs = []
-    if zipfile.is_zipfile(f):
-        with zipfile.ZipFile(f) as zf:
-            members = _filter_archive_members(
-                zf.infolist(), pattern=pattern, is_zip=True
-            )
-            if extract:
-                zf.extractall(path=path, members=members)
-            imgs = [m.filename for m in members]
-    elif tarfile.is_tarfile(f):
-        with tarfile.open(f) as tf:
-            members = _filter_archive_members(tf, pattern=pattern, is_zip=False)
-            if extract:
-                if sys.version_info >= (3, 12):
-                    tf.extractall(path=path, members=members, filter="data")
-                else:
-                    tf.extractall(path=path, members=members)
-            imgs = [m.name for m in members]
+    if extract:
+        os.makedirs(path, exist_ok=True)
+    for name, fh in iter_archive(f, pattern=pattern):
+        if extract:
+            with open(os.path.join(path, name), "wb") as out:
+                shutil.copyfileobj(fh, out)
+        imgs.append(name)
     return imgs
+
+
+def _read_head(fileobj, size, compressed=None):
+    """
+    Read the first `size` bytes of a stream, decompressing it if gzipped.
+    If `compressed` is None, this is detected from the stream itself.
+    Only as much of the stream as needed is consumed. Returns None if the
+    stream is not compressed as expected.
+    """
+    head = fileobj.read(2)
+    is_gzip = head == b"\x1f\x8b"
+    if compressed is not None and compressed != is_gzip:
+        return None
+    if not is_gzip:
+        return head + fileobj.read(size - len(head))
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.decompress(head)
+    while len(data) < size:
+        chunk = decompressor.unconsumed_tail or fileobj.read(1024)
+        if not chunk:
+            break
+        data += decompressor.decompress(chunk, size - len(data))
+    return data
+
+
+def read_nifti_header(fileobj, compressed=None):
+    """
+    Parse the NIfTI-1 or NIfTI-2 header at the start of a (gzipped) stream.
+    If `compressed` is None, gzip compression is detected from the stream.
+    Returns None if the stream does not start with a valid NIfTI header.
+    """
+    # Only needed by the imaging tasks, so keep it out of module scope.
+    import nibabel as nib
+
+    try:
+        head = _read_head(fileobj, _NIFTI_HEADER_MAX_SIZE, compressed)
+    except zlib.error:
+        return None
+    if head is None:
+        return None
+    sizeof_hdr = {int.from_bytes(head[:4], "little"), int.from_bytes(head[:4], "big")}
+    for header_class in (nib.Nifti1Header, nib.Nifti2Header):
+        if header_class.sizeof_hdr not in sizeof_hdr:
+            continue
+        try:
+            header = header_class.from_fileobj(io.BytesIO(head), check=True)
+        except (nib.spatialimages.HeaderDataError, ValueError):
+            return None
+        if header["magic"] == header_class.single_magic:
+            return header
+    return None
+
+
+def read_archive_headers(f, pattern=""):
+    """
+    Read the NIfTI header of every matching file in a tar/zipfile, without
+    extracting anything to disk. As with nib.load, files are expected to be
+    gzipped if and only if their name ends with ".gz".
+    Returns a list of (filename, header) pairs; header is None for files
+    that are not NIfTI.
+    """
+    return [
+        (name, read_nifti_header(fh, compressed=name.endswith(".gz")))
+        for name, fh in iter_archive(f, pattern=pattern)
+    ]
+
+
+def load_label_map(path):
+    """
+    Load a NIfTI label map as a uint8 array, in its stored data type
+    instead of the float64 of get_fdata(), i.e. 8x smaller.
+    Raises ValueError if it holds anything but integers from 0 to 255.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    data = np.asanyarray(nib.load(path).dataobj)
+    if data.dtype == np.uint8:
+        return data
+    if data.dtype.kind == "f" and not np.array_equal(data, np.floor(data)):
+        raise ValueError(f"{path} holds non-integer values.")
+    if data.size and (data.min() < 0 or data.max() > 255):
+        raise ValueError(f"{path} holds values outside of 0-255.")
+    return data.astype(np.uint8)
+
+
+def match_case_ids(names, pattern):
+    """
+    Match NIfTI filenames against `pattern` followed by ".nii.gz", compiling
+    the pattern only once. Returns a {filename: case ID} dict of the matching
+    filenames (the ID being the pattern's first group), and a list of the
+    filenames that do not match.
+    """
+    regex = re.compile(fr"{pattern}\.nii\.gz$")
+    case_ids, nonconforming = {}, []
+    for name in names:
+        match = regex.search(name)
+        if match:
+            case_ids[name] = match.group(1)
+        else:
+            nonconforming.append(name)
+    return case_ids, nonconforming
+
+
+def check_case_ids(preds, pattern, known_ids):
+    """
+    Compare the case IDs of prediction filenames with the known case IDs,
+    e.g. those of the goldstandard. Returns the sets of nonconforming
+    filenames, and of duplicate, unknown and missing case IDs.
+    """
+    case_ids, nonconforming = match_case_ids(preds, pattern)
+    counts = Counter(case_ids.values())
+    return {
+        "nonconforming": set(nonconforming),
+        "duplicate": {case_id for case_id, count in counts.items() if count > 1},
+        "unknown": counts.keys() - known_ids,
+        "missing": known_ids - counts.keys(),
+    }
+
+
+def summarize_report(report):
+    """
+    Return one error message per failure reason in a report mapping files
+    to the reason they failed a check, listing the affected files.
+    """
+    failed = {}
+    for pred, reason in sorted(report.items()):
+        failed.setdefault(reason, []).append(pred)
+    return [
+        f"{reason.rstrip('.')}: {', '.join(preds)}"
+        for reason, preds
+        in failed.items()
+    ]
+
+
+def build_manifest(f, case_id_pattern=None):
+    """
+    Index a tar/zipfile, e.g. a goldstandard, so that later runs do not
+    need to list it again: the SHA-256 digest of the archive, and the path,
+    name and size of every member. If `case_id_pattern` is given, the case
+    ID of every member matching it is included too (see match_case_ids).
+    """
+    members = [
+        {"path": path, "name": os.path.basename(path), "size": size}
+        for path, size, _ in _iter_members(f)
+    ]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "sha256": file_digest(f),
+        "members": members,
+    }
+    if case_id_pattern is not None:
+        case_ids, _ = match_case_ids([m["name"] for m in members], case_id_pattern)
+        manifest["case_id_pattern"] = case_id_pattern
+        manifest["case_ids"] = case_ids
+    return manifest
+
+
+def load_manifest(f, manifest_path=None):
+    """
+    Load the manifest of a tar/zipfile, from `manifest_path` or else from
+    "<f>.manifest.json" next to it. Returns None if there is none, or if it
+    does not match the archive (e.g. the archive has since been updated).
+
+    Checking the archive's digest reads it once, without decompressing it,
+    which is still much faster than listing a large tar.gz.
+    """
+    manifest_path = manifest_path or f"{f}.manifest.json"
+    try:
+        with open(manifest_path, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        print(f"Ignoring unreadable manifest {manifest_path}: {err}", file=sys.stderr)
+        return None
+    if (
+        manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("sha256") != file_digest(f)
+    ):
+        print(f"Ignoring stale manifest {manifest_path}", file=sys.stderr)
+        return None
+    return manifest
+
+
+def list_archive(f, pattern="", manifest=None):
+    """
+    List the filenames of a tar/zipfile like inspect_archive(extract=False),
+    but from its manifest (see load_manifest) if given.
+    """
+    if manifest is None:
+        return inspect_archive(f, extract=False, pattern=pattern)
+    return [m["name"] for m in manifest["members"] if pattern in m["path"]]
+
+
+def match_gold_case_ids(golds, pattern, manifest=None):
+    """
+    Return the {filename: case ID} dict of goldstandard filenames, like
+    match_case_ids, but from the case IDs of its manifest (see
+    load_manifest) if given and built with the same pattern.
+    """
+    if manifest is None or manifest.get("case_id_pattern") != pattern:
+        return match_case_ids(golds, pattern)[0]
+    golds = set(golds)
+    return {
+        name: case_id
+        for name, case_id in manifest["case_ids"].items()
+        if name in golds
+    }
+
+
+def file_digest(f):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(f, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_key(name, *files):
+    """
+    Return a key identifying `name` together with the contents of `files`,
+    e.g. a case ID and its prediction and reference files.
+    """
+    key = hashlib.sha256(name.encode())
+    for f in files:
+        key.update(file_digest(f).encode())
+    return key.hexdigest()
+
+
+def load_checkpoints(path):
+    """
+    Load the records of a checkpoint file (see save_checkpoint) as a dict.
+    A missing file has no records. A partially written last record, e.g.
+    from a run that was killed, is dropped from the file.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r+b") as f:
+        lines = f.read().splitlines(keepends=True)
+        if lines and not lines[-1].endswith(b"\n"):
+            f.truncate(f.tell() - len(lines.pop()))
+    for line in lines:
+        record = json.loads(line)
+        records[record["key"]] = record["value"]
+    return records
+
+
+def save_checkpoint(path, key, value):
+    """Append a record to a JSON Lines checkpoint file, and flush it to disk."""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"key": key, "value": value}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def memo_get(memo_dir, key):
+    """Return the value memoized under `key` in `memo_dir`, or None."""
+    path = os.path.join(memo_dir, f"{key}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            value = json.load(f)
+        os.utime(path)  # mark as most recently used
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return value
+
+
+def memo_put(memo_dir, key, value, max_bytes=MEMO_MAX_BYTES):
+    """
+    Memoize `value` under `key` in `memo_dir`, which can be shared between
+    processes. Least recently used values are evicted once the directory
+    grows past `max_bytes`.
+    """
+    os.makedirs(memo_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=memo_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as out:
+        json.dump(value, out)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, os.path.join(memo_dir, f"{key}.json"))
+
+    entries, total = [], 0
+    for entry in os.scandir(memo_dir):
+        if entry.name.endswith(".json"):
+            stat_result = entry.stat()
+            entries.append((stat_result.st_mtime, stat_result.st_size, entry.path))
+            total += stat_result.st_size
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already evicted by another process
+        total -= size
+
+
+def _dir_size(path):
+    """Return the total size of the files under `path`."""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def _remove_dir(path, cache_dir):
+    """
+    Remove a cache entry. It is first renamed out of the way, so that other
+    processes never see a partially deleted entry.
+    """
+    trash = tempfile.mkdtemp(prefix=".evict-", dir=cache_dir)
+    try:
+        os.rename(path, os.path.join(trash, "entry"))
+    except OSError:
+        pass  # already removed by another process
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def _evict(cache_dir, max_bytes, keep):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    entries, total = [], 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir():
+            continue
+        mtime = entry.stat().st_mtime
+        if entry.name.startswith("."):
+            # Leftovers of interrupted extractions or evictions.
+            if time.time() - mtime > 24 * 60 * 60:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        size = _dir_size(entry.path)
+        entries.append((mtime, size, entry.path))
+        total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry != keep:
+            _remove_dir(entry, cache_dir)
+            total -= size
+
+
+def extract_cached(f, path, cache_dir=None, pattern="", max_bytes=CACHE_MAX_BYTES):
+    """
+    Extract matching files of a tar/zipfile, reusing an earlier extraction of
+    the same archive (by content) from `cache_dir` if there is one.
+
+    New entries are extracted to a temporary directory and then renamed into
+    place, so that concurrent processes sharing `cache_dir` only ever see
+    complete entries. Least recently used entries are evicted once the cache
+    grows past `max_bytes`.
+
+    Callers may keep derived data for the entry (e.g. decoded volumes) in
+    subdirectories of it; they are evicted along with the entry.
+
+    Without a `cache_dir`, the files are simply extracted to `path`.
+    Returns the directory holding the extracted files, and their filenames.
+    """
+    if not cache_dir:
+        return path, inspect_archive(f, path=path, pattern=pattern)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha256(f"{file_digest(f)}:{pattern}".encode()).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    while True:
+        if not os.path.isdir(entry):
+            tmp = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+            os.chmod(tmp, 0o755)
+            inspect_archive(f, path=tmp, pattern=pattern)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Another process published the same entry first.
+                shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            os.utime(entry)  # mark as most recently used
+            break
+        except FileNotFoundError:
+            continue  # evicted by another process in the meantime
+    _evict(cache_dir, max_bytes, keep=entry)
+    return entry, sorted(e.name for e in os.scandir(entry) if e.is_file())
+
+
+def _current_rss():
+    """Return the resident memory of this process in bytes, if known."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Record the wall time of a stage, and the peak resident memory of this
+    process during it (sampled every RSS_SAMPLE_INTERVAL), in
+    timings[stage]. The peak memory of subprocesses finished during the
+    stage is recorded too.
+    """
+    peak = [0]
+    stop = threading.Event()
+
+    def sample():
+        while True:
+            peak[0] = max(peak[0], _current_rss() or 0)
+            if stop.wait(RSS_SAMPLE_INTERVAL):
+                return
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        timings[stage] = {"wall_s": round(wall, 3)}
+        if peak[0]:
+            timings[stage]["peak_rss_mb"] = round(peak[0] / 1024**2, 1)
+        # ru_maxrss is in kilobytes, and only ever grows.
+        children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if children_peak > children:
+            timings[stage]["children_peak_rss_mb"] = round(children_peak / 1024, 1)
+
+
+@contextmanager
+def profiled(path=None):
+    """Profile the block with cProfile and dump the stats to path, if given."""
+    if not path:
+        yield
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def write_timings(path, timings):
+    """Write the recorded stage timings, and overall peak memory, as JSON."""
+    with open(path, "w", encoding="utf-8") as out:
+        json.dump(
+            {
+                "stages": timings,
+                "max_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+            },
+            out,
+            indent=2,
+        )
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""Long-running worker for the BraTS evaluation scripts.
+
+Every submission normally starts a fresh interpreter, which imports torch,
+panoptica, etc. all over again. Instead, a worker started once per node
+runs the scripts' main() in processes forked from it, so that the packages
+it preloads stay imported from one job to the next:
+
+    python worker.py --spool_dir /var/spool/brats
+
+The scripts keep their command-line interface: when BRATS_SPOOL_DIR is set,
+`score.py ARGS` only hands its arguments and working directory over to the
+worker as a job, waits for it, then prints its output and exits with its
+exit code. The worker must see the jobs' files at the same paths as the
+scripts do, e.g. by running in the same image with the same mounts.
+
+Jobs go through subdirectories of the spool directory: the client writes
+incoming/<id>.json, the worker claims it by moving it to running/, and
+writes done/<id>.json (exit code) and done/<id>.log (output) when it is
+finished. Several workers can share a spool directory.
+
+Each job runs in a child process forked from the worker, so that a job
+that crashes (e.g. OOM kill or segfault) fails on its own rather than
+taking the worker down. The goldstandards a job loads are therefore not
+kept in memory for the next job. To reuse them, pass the scripts a cache
+directory (--script_args "SCRIPT=--cache_dir DIR"): goldstandards are then
+only extracted once, and inpainting's decoded references are kept as .npy
+files that every job memory-maps.
+
+While running, a worker touches its heartbeat file in workers/ and the
+file of its current job in running/. If no worker is alive, or the one
+running a job stops responding, the client runs the script itself
+instead, the same as without BRATS_SPOOL_DIR. A client that gives up on
+a job removes its file from running/, and the worker then kills the job,
+along with any process it started.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import shlex
+import signal
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+# Environment variable with the spool directory to hand jobs over to.
+SPOOL_ENV = "BRATS_SPOOL_DIR"
+
+# Environment variable with the time (s) to wait for a job.
+TIMEOUT_ENV = "BRATS_SPOOL_TIMEOUT"
+
+# Time (in seconds) to wait for a job by default.
+DEFAULT_TIMEOUT = 4 * 60 * 60
+
+# Interval (in seconds) between checks for new or finished jobs.
+POLL_INTERVAL = 0.1
+
+# Interval (in seconds) between heartbeats of a worker, and time after
+# which a worker without heartbeats is taken to be gone.
+HEARTBEAT_INTERVAL = 5
+STALE_AFTER = 60
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spool_dir", type=str,
+                        default=os.environ.get(SPOOL_ENV))
+    parser.add_argument("--preload", nargs="+", default=[],
+                        help="Modules to import before taking jobs, e.g. "
+                             "torch panoptica.")
+    parser.add_argument("--script_args", action="append", default=[],
+                        metavar="SCRIPT=ARGS",
+                        help="Extra arguments for every job of a script, "
+                             "e.g. 'score.py=--cache_dir /var/cache/brats'.")
+    parser.add_argument("--max_jobs", type=int, default=None,
+                        help="Exit after this many jobs.")
+    return parser.parse_args()
+
+
+def _spool_dirs(spool_dir):
+    dirs = {name: os.path.join(spool_dir, name)
+            for name in ("incoming", "running", "done", "workers")}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def _write_json(path, data):
+    """Write a JSON file atomically, so that it is never read half-written."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as out:
+        json.dump(data, out)
+    os.replace(tmp, path)
+
+
+def _touch(path):
+    """Update the modification time of a heartbeat file, if it still exists."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _since_touched(path):
+    """Return the time (s) since a heartbeat file was touched, or None if it is gone."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+def _workers_alive(dirs):
+    """Return whether any worker on the spool directory has a recent heartbeat."""
+    ages = (
+        _since_touched(os.path.join(dirs["workers"], name))
+        for name in os.listdir(dirs["workers"])
+    )
+    return any(age is not None and age < STALE_AFTER for age in ages)
+
+
+def _withdraw(path):
+    """
+    Remove a job file. Returns False if it was already gone: claimed or
+    finished by a worker, or withdrawn by its client.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def submit(script, args, spool_dir, timeout=DEFAULT_TIMEOUT):
+    """
+    Hand a script run over to the worker, and wait for it to finish.
+    Prints the output of the run, and returns its exit code, or None if the
+    script has to be run locally instead: no worker is alive, none claimed
+    the job within `timeout` seconds, or the one running it stopped
+    responding. A job still running after `timeout` seconds is cancelled
+    (see run_job_in_child), and fails.
+    """
+    dirs = _spool_dirs(spool_dir)
+    if not _workers_alive(dirs):
+        print(f"No worker is running on {spool_dir}.", file=sys.stderr)
+        return None
+    job_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    incoming = os.path.join(dirs["incoming"], f"{job_id}.json")
+    running = os.path.join(dirs["running"], f"{job_id}.json")
+    _write_json(incoming, {
+        "script": os.path.realpath(script),
+        "args": list(args),
+        "cwd": os.getcwd(),
+    })
+
+    # Withdrawing the job file fails if the worker has just claimed, or
+    # finished, the job; it is then waited for as usual.
+    done = os.path.join(dirs["done"], f"{job_id}.json")
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(done):
+        if os.path.exists(incoming):
+            if (
+                not _workers_alive(dirs) or time.monotonic() > deadline
+            ) and _withdraw(incoming):
+                print(f"No worker took up job {job_id} in {spool_dir}.",
+                      file=sys.stderr)
+                return None
+        elif (_since_touched(running) or 0) > STALE_AFTER:
+            if _withdraw(running):
+                print(f"The worker running job {job_id} in {spool_dir} stopped "
+                      "responding.", file=sys.stderr)
+                return None
+        elif time.monotonic() > deadline:
+            if _withdraw(running):
+                print(f"Timed out waiting for job {job_id} in {spool_dir}; "
+                      "cancelled it.", file=sys.stderr)
+                return 1
+        time.sleep(POLL_INTERVAL)
+
+    with open(done, encoding="utf-8") as f:
+        returncode = json.load(f)["returncode"]
+    log = os.path.join(dirs["done"], f"{job_id}.log")
+    with open(log, "rb") as f:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(f.read())
+        sys.stdout.flush()
+    os.remove(done)
+    os.remove(log)
+    return returncode
+
+
+def run(main, script):
+    """
+    Run a script's main(), or hand it over to the worker if BRATS_SPOOL_DIR
+    is set (and this is not the worker itself). Falls back to running it
+    here if the worker cannot run it (see submit).
+    """
+    spool_dir = os.environ.get(SPOOL_ENV)
+    if spool_dir:
+        timeout = os.environ.get(TIMEOUT_ENV)
+        returncode = submit(script, sys.argv[1:], spool_dir,
+                            float(timeout) if timeout else DEFAULT_TIMEOUT)
+        if returncode is not None:
+            sys.exit(returncode)
+        print("Running the script locally instead.", file=sys.stderr)
+    main()
+
+
+@contextmanager
+def _redirected(path):
+    """Send everything written to stdout and stderr, also by subprocesses, to a file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(path, "wb") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+def _load_script(path, scripts):
+    """Import a script as a module, once per worker."""
+    if path not in scripts:
+        relative = os.path.relpath(path, SCRIPTS_DIR)
+        name = "job_" + os.path.splitext(relative)[0].replace(os.sep, "_")
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        # Registered, so that process pools of the script can find it.
+        sys.modules[name] = module
+        sys.path.insert(0, os.path.dirname(path))
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.pop(0)
+        scripts[path] = module
+    return scripts[path]
+
+
+def run_job(job, scripts, log_path, script_args=None):
+    """Run a job's script in this process. Returns its exit code."""
+    script = job["script"]
+    if os.path.commonpath([SCRIPTS_DIR, script]) != SCRIPTS_DIR:
+        with open(log_path, "w", encoding="utf-8") as log:
+            log.write(f"Not an evaluation script: {script}\n")
+        return 1
+    extra = shlex.split((script_args or {}).get(os.path.relpath(script, SCRIPTS_DIR), ""))
+
+    cwd, argv = os.getcwd(), sys.argv
+    with _redirected(log_path):
+        try:
+            module = _load_script(script, scripts)
+            os.chdir(job["cwd"])
+            sys.argv = [script, *job["args"], *extra]
+            module.main()
+            returncode = 0
+        except SystemExit as err:
+            if err.code is None or isinstance(err.code, int):
+                returncode = err.code or 0
+            else:
+                print(err.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+    return returncode
+
+
+def _run_job_and_exit(job, log_path, script_args):
+    # In a process group of its own, so that it can be killed along with
+    # the processes it starts.
+    os.setpgid(0, 0)
+    sys.exit(run_job(job, {}, log_path, script_args))
+
+
+def run_job_in_child(job, log_path, script_args=None, heartbeats=(), job_file=None):
+    """
+    Run a job in a child process forked from this one, so that preloaded
+    modules stay warm, but a crash of the job cannot take this process
+    down. Touches the `heartbeats` files while it runs. Returns the job's
+    exit code (128 + the signal number if it was killed).
+
+    If `job_file` is removed while the job runs, i.e. its client gave up on
+    it, the job is killed, along with any process it started, and None is
+    returned.
+    """
+    import multiprocessing
+
+    process = multiprocessing.get_context("fork").Process(
+        target=_run_job_and_exit, args=(job, log_path, script_args)
+    )
+    process.start()
+    try:
+        os.setpgid(process.pid, process.pid)
+    except OSError:
+        # The child already did it, or has already exited.
+        pass
+    while process.exitcode is None:
+        if job_file is not None and not os.path.exists(job_file):
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.join()
+            return None
+        for path in heartbeats:
+            _touch(path)
+        process.join(HEARTBEAT_INTERVAL)
+    if process.exitcode < 0:
+        with open(log_path, "a", encoding="utf-8") as log:
+            log.write(
+                f"Job process died ({signal.Signals(-process.exitcode).name}).\n"
+            )
+        return 128 - process.exitcode
+    return process.exitcode
+
+
+def serve(spool_dir, script_args=None, max_jobs=None):
+    """Take jobs from the spool directory, oldest first, and run them."""
+    dirs = _spool_dirs(spool_dir)
+    heartbeat = os.path.join(dirs["workers"], f"{os.uname().nodename}-{os.getpid()}")
+    with open(heartbeat, "w", encoding="utf-8"):
+        pass
+    jobs = 0
+    try:
+        while max_jobs is None or jobs < max_jobs:
+            _touch(heartbeat)
+            incoming = sorted(
+                name for name in os.listdir(dirs["incoming"]) if name.endswith(".json")
+            )
+            if not incoming:
+                time.sleep(POLL_INTERVAL)
+                continue
+            name = incoming[0]
+            running = os.path.join(dirs["running"], name)
+            try:
+                # Touched first, so that the job is not stale once claimed.
+                os.utime(os.path.join(dirs["incoming"], name))
+                os.rename(os.path.join(dirs["incoming"], name), running)
+            except FileNotFoundError:
+                # Claimed by another worker, or withdrawn by its client.
+                continue
+            with open(running, encoding="utf-8") as f:
+                job = json.load(f)
+
+            job_id = os.path.splitext(name)[0]
+            log = os.path.join(dirs["done"], f"{job_id}.log")
+            done = os.path.join(dirs["done"], name)
+            start = time.perf_counter()
+            returncode = run_job_in_child(
+                job, log, script_args, heartbeats=(heartbeat, running),
+                job_file=running,
+            )
+            if returncode is not None:
+                _write_json(done, {"returncode": returncode})
+            if returncode is None or not _withdraw(running):
+                # Its client gave up on the job (see submit).
+                _withdraw(done)
+                _withdraw(log)
+                outcome = "was cancelled"
+            else:
+                outcome = f"exited with {returncode}"
+            jobs += 1
+            print(
+                f"{job_id}: {os.path.relpath(job['script'], SCRIPTS_DIR)} {outcome} "
+                f"after {time.perf_counter() - start:.1f}s",
+                file=sys.stderr,
+            )
+    finally:
+        os.remove(heartbeat)
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    if not args.spool_dir:
+        sys.exit(f"--spool_dir (or {SPOOL_ENV}) is required.")
+    # Jobs run here, rather than being handed over again.
+    os.environ.pop(SPOOL_ENV, None)
+    for module in args.preload:
+        importlib.import_module(module)
+    script_args = dict(arg.split("=", 1) for arg in args.script_args)
+    serve(args.spool_dir, script_args, args.max_jobs)
+
+
+if __name__ == "__main__":
+    main()